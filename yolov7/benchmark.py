@@ -0,0 +1,380 @@
+import argparse
+import glob
+import json
+import os
+import random
+import time
+from copy import deepcopy
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+import torch
+import yaml
+
+import test  # test.py
+from models.experimental import Ensemble, attempt_load, save_fused
+from models.yolo import Model, activation_lifetimes
+from utils.datasets import DataloaderProfiler, LoadImagesAndLabels, create_dataloader, load_mosaic, load_mosaic9
+from utils.general import check_file, check_img_size, colorstr, set_logging
+from utils.metrics import ap_per_class, compute_ap
+from utils.torch_utils import LayerProfiler, inference_mode, select_device, time_synchronized
+
+
+def mosaic(data, hyp, imgsz=640, n=300, warmup=10, cache=True, task='train'):
+    # Single-process (i.e. per dataloader worker) load_mosaic() / load_mosaic9() throughput in samples/s
+    with open(data) as f:
+        data = yaml.load(f, Loader=yaml.SafeLoader)
+    with open(hyp) as f:
+        hyp = yaml.load(f, Loader=yaml.SafeLoader)
+    dataset = LoadImagesAndLabels(data[task], imgsz, augment=True, hyp=hyp, cache_images=cache,
+                                  prefix=colorstr(f'{task}: '))
+
+    results = {}
+    for fn in load_mosaic, load_mosaic9:
+        random.seed(0)
+        np.random.seed(0)
+        for i in range(warmup):
+            fn(dataset, i % len(dataset))
+        t = time.perf_counter()
+        for i in range(n):
+            fn(dataset, i % len(dataset))
+        results[fn.__name__] = n / (time.perf_counter() - t)
+        print(f'{fn.__name__:>20s}{results[fn.__name__]:12.1f} samples/s per worker')
+    return results
+
+
+def dataloader(data, hyp, imgsz=640, batch_size=16, workers=8, n=50, warmup=5, cache=False, augment=True,
+               fused_augment=False, task='train'):
+    # create_dataloader() throughput in images/s independent of any model, with per-stage loading times
+    with open(data) as f:
+        data = yaml.load(f, Loader=yaml.SafeLoader)
+    with open(hyp) as f:
+        hyp = yaml.load(f, Loader=yaml.SafeLoader)
+    opt = argparse.Namespace(single_cls=False)
+    profiler = DataloaderProfiler()  # sized by create_dataloader()
+    val = task != 'train'  # validation pipeline as in test.py
+    loader = create_dataloader(data[task], imgsz, batch_size, 32, opt, hyp=hyp, augment=augment and not val,
+                               cache=cache, pad=0.5 if val else 0.0, rect=val, workers=workers,
+                               prefix=colorstr(f'{task}: '), fused_augment=fused_augment, profiler=profiler)[0]
+
+    it = (batch for _ in iter(int, 1) for batch in loader)  # repeat over epochs
+    for _ in islice(it, warmup):
+        pass
+    profiler.reset()
+    seen, wait, t = 0, 0.0, time.perf_counter()
+    for _ in range(n):
+        tw = time.perf_counter()
+        img, *_ = next(it)
+        wait += time.perf_counter() - tw  # main process blocked on the dataloader
+        seen += img.shape[0]
+    dt = time.perf_counter() - t
+    nw = loader.num_workers
+
+    print(f'{seen / dt:.1f} images/s ({n} batches of {batch_size}, {nw} workers, augment={augment and not val}, '
+          f'fused_augment={fused_augment}), main process waited {wait / n * 1E3:.1f} ms/batch')
+    times = profiler.times.sum(0)
+    for stage, x in zip(profiler.stages, times.tolist()):
+        print(f'{stage:>20s}{x / seen * 1E3:10.2f} ms/image{x / max(times.sum().item(), 1E-9):10.1%}')
+    busy = profiler.times.sum(1)  # per worker
+    idle = (1 - busy / dt).clamp(0).tolist()  # fraction of wall time not spent loading
+    print('worker idle: ' + ', '.join(f'{x:.1%}' for x in idle))
+    return seen / dt, dict(zip(profiler.stages, times.tolist())), idle
+
+
+def ap(n=100000, classes=(1, 20, 80, 365, 1203), niou=10, repeats=3):
+    # ap_per_class() time on synthetic statistics vs. a per-class, per-threshold compute_ap() loop
+    rng = np.random.default_rng(0)
+    results = {}
+    for nc in classes:
+        conf = rng.random(n).astype(np.float32)
+        pred_cls = rng.integers(0, nc, n).astype(np.float32)
+        tp = rng.random((n, niou)) < conf[:, None] * np.linspace(0.9, 0.1, niou)  # more TPs at high confidence
+        target_cls = rng.integers(0, nc, n // 2).astype(np.float32)
+
+        t = time.perf_counter()
+        for _ in range(repeats):
+            ap_per_class(tp, conf, pred_cls, target_cls)
+        t1 = (time.perf_counter() - t) / repeats
+
+        t = time.perf_counter()
+        for _ in range(repeats):  # reference: one class and one IoU threshold at a time
+            i = np.argsort(-conf)
+            px = np.linspace(0, 1, 1000)
+            for c in np.unique(target_cls):
+                j = i[pred_cls[i] == c]
+                fpc, tpc = (1 - tp[j]).cumsum(0), tp[j].cumsum(0)
+                recall, precision = tpc / ((target_cls == c).sum() + 1E-16), tpc / (tpc + fpc)
+                np.interp(-px, -conf[j], recall[:, 0], left=0), np.interp(-px, -conf[j], precision[:, 0], left=1)
+                for k in range(niou):
+                    compute_ap(recall[:, k], precision[:, k])
+        t2 = (time.perf_counter() - t) / repeats
+        results[nc] = t1, t2
+        print(f'{nc:>8d} classes{t1 * 1E3:10.1f} ms ap_per_class(){t2 * 1E3:10.1f} ms per-class loop{t2 / t1:8.1f}x')
+    return results
+
+
+def memory(cfgs, imgsz=640, batch_size=1, device=''):
+    # Peak inference activation memory of Model.forward_once() freeing each output after its last consumer vs. keeping
+    # every indexed output until the end of the forward pass, from layer output sizes and, on CUDA, measured
+    device = select_device(device)
+    nbytes = lambda y: y.numel() * y.element_size() if isinstance(y, torch.Tensor) else sum(map(nbytes, y))
+    results = {}
+    print(('%30s' + '%10s' + '%14s' * 3) % ('cfg', 'layers', 'freed MB', 'kept MB', 'reduction'))
+    for cfg in cfgs:
+        model = Model(cfg).to(device).eval()
+        x = torch.zeros(batch_size, 3, imgsz, imgsz, device=device)
+        size = []  # output bytes per layer
+        hooks = [m.register_forward_hook(lambda m, i, y: size.append(nbytes(y))) for m in model.model]
+        with torch.no_grad():
+            model(x[:1])
+        for h in hooks:
+            h.remove()
+
+        # Outputs alive while layer i runs: indexed outputs still needed (or all of them before), previous and own output
+        _, last = activation_lifetimes(model.model)
+        freed, kept = 0, 0
+        for i in range(len(size)):
+            previous = {i - 1} if i else set()
+            freed = max(freed, sum(size[j] for j in {j for j, k in last.items() if j < i <= k} | previous) + size[i])
+            kept = max(kept, sum(size[j] for j in {j for j in last if j < i} | previous) + size[i])
+        freed, kept = freed * batch_size / 1E6, kept * batch_size / 1E6
+        results[cfg] = {'freed': freed, 'kept': kept}
+        print(f'{Path(cfg).name:>30s}{len(size):10d}{freed:14.1f}{kept:14.1f}{1 - freed / kept:14.1%}')
+
+        if device.type != 'cpu':  # measured, the previous behaviour by holding on to every indexed output
+            measured = []
+            for keep in False, True:
+                held = []
+                hooks = [model.model[j].register_forward_hook(lambda m, i, y: held.append(y)) for j in model.save] \
+                    if keep else []
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(device)
+                base = torch.cuda.memory_allocated(device)
+                with torch.no_grad():
+                    model(x)
+                measured.append((torch.cuda.max_memory_allocated(device) - base) / 1E6)
+                for h in hooks:
+                    h.remove()
+                del held
+            results[cfg].update({'cuda_freed': measured[0], 'cuda_kept': measured[1]})
+            print(f'{"measured on CUDA":>40s}{measured[0]:14.1f}{measured[1]:14.1f}{1 - measured[0] / measured[1]:14.1%}')
+    return results
+
+
+def tta(data, weights, imgsz=640, batch_size=16, device='', scale_sets=((1, 0.83, 0.67), (1, 0.83), (1.2, 1, 0.83))):
+    # Test-time augmentation val set mAP and latency per scale set: views run per shape or padded into one batch, and
+    # concatenated predictions into plain NMS or merge-NMS (weighted box fusion)
+    device = select_device(device, batch_size=batch_size)
+    model = attempt_load(weights, map_location=device)
+    gs = max(int(model.stride.max()), 32)  # grid size (max stride)
+    imgsz = check_img_size(imgsz, s=gs)
+    with open(data) as f:
+        path = yaml.load(f, Loader=yaml.SafeLoader)['val']
+    opt = argparse.Namespace(single_cls=False)
+    loader = create_dataloader(path, imgsz, batch_size, gs, opt, pad=0.5, rect=True, prefix=colorstr('val: '))[0]
+
+    results = []
+    for scales, pad, merge in [(None, False, False)] + [(s, p, m) for s in scale_sets for p in (False, True)
+                                                         for m in (False, True)]:
+        model.tta_scales, model.tta_pad = scales or model.tta_scales, pad  # this model only
+        (mp, mr, map50, map, *_), _, t = test.test(data, batch_size=batch_size, imgsz=imgsz, model=model,
+                                                   dataloader=loader, plots=False, augment=scales is not None,
+                                                   merge=merge)
+        results.append((scales, pad, merge, map50, map, *t[:2]))
+
+    print(('%20s' + '%8s' * 2 + '%12s' * 4) % ('scales', 'pad', 'merge', 'mAP@.5', 'mAP@.5:.95', 'infer ms', 'NMS ms'))
+    for scales, pad, merge, *x in results:
+        print(('%20s' + '%8s' * 2 + '%12.4g' * 2 + '%12.1f' * 2) % (scales or 'none', pad, merge, *x))
+    return results
+
+
+def ensemble(data, weights, imgsz=640, batch_size=16, device='', n=20, warmup=3):
+    # Ensemble latency of each member and of all members run sequentially or concurrently, and val set mAP of
+    # concatenated member predictions into NMS vs. weighted box fusion of member detections
+    device = select_device(device, batch_size=batch_size)
+    model = attempt_load(weights, map_location=device)
+    assert isinstance(model, Ensemble), 'ensemble benchmark requires 2 or more weights'
+    gs = max(int(model.stride.max()), 32)  # grid size (max stride)
+    imgsz = check_img_size(imgsz, s=gs)
+    x = torch.rand(batch_size, 3, imgsz, imgsz, device=device)
+
+    def latency(m):
+        with torch.no_grad():
+            for _ in range(warmup):
+                m(x)
+            t = time_synchronized()
+            for _ in range(n):
+                m(x)
+        return (time_synchronized() - t) / n * 1E3
+
+    times = [latency(m) for m in model]
+    for parallel in False, True:
+        model.parallel = parallel
+        times.append(latency(model))
+    print(('%12s' * (len(times) + 1)) % (*[f'model {i} ms' for i in range(len(model))], 'sequential', 'parallel',
+                                         'speedup'))
+    print(('%12.1f' * len(times) + '%11.2fx') % (*times, times[-2] / times[-1]))
+
+    with open(data) as f:
+        path = yaml.load(f, Loader=yaml.SafeLoader)['val']
+    opt = argparse.Namespace(single_cls=False)
+    loader = create_dataloader(path, imgsz, batch_size, gs, opt, pad=0.5, rect=True, prefix=colorstr('val: '))[0]
+    results = []
+    for fusion in 'nms', 'wbf':
+        model.fusion = fusion
+        (mp, mr, map50, map, *_), _, t = test.test(data, batch_size=batch_size, imgsz=imgsz, model=model,
+                                                   dataloader=loader, plots=False)
+        results.append((fusion, map50, map, *t[:2]))
+
+    print(('%10s' + '%12s' * 4) % ('fusion', 'mAP@.5', 'mAP@.5:.95', 'infer ms', 'NMS ms'))
+    for fusion, *r in results:
+        print(('%10s' + '%12.4g' * 2 + '%12.1f' * 2) % (fusion, *r))
+    return times, results
+
+
+def layers(cfgs, data, imgsz=640, batch_size=1, device='', n=50, warmup=5, save_dir='runs/layers'):
+    # Per layer latency, FLOPs, parameters and activation sizes of fused models over val set batches, saved per cfg as
+    # CSV and JSON and for all cfgs as one Chrome trace (one process per cfg, open in chrome://tracing or Perfetto)
+    device = select_device(device, batch_size=batch_size)
+    save_dir = Path(save_dir)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    with open(data) as f:
+        path = yaml.load(f, Loader=yaml.SafeLoader)['val']
+    opt = argparse.Namespace(single_cls=False)
+    loader = create_dataloader(path, imgsz, batch_size, 32, opt, pad=0.5, rect=True, prefix=colorstr('val: '))[0]
+
+    results, trace = {}, []
+    for k, cfg in enumerate(cfgs):
+        batches = (img.to(device, non_blocking=True).float() / 255.0 for _ in iter(int, 1) for img, *_ in loader)
+        with torch.no_grad():
+            model = Model(cfg).to(device).fuse().eval()
+            for img in islice(batches, warmup):
+                model(img)
+            with LayerProfiler(model) as p:
+                for img in islice(batches, n):
+                    model(img)
+
+        name = Path(cfg).stem
+        print(f'\n{name}')
+        p.print()
+        p.save_csv(save_dir / f'{name}.csv')
+        p.save_json(save_dir / f'{name}.json')
+        trace += [{'name': 'process_name', 'ph': 'M', 'pid': k, 'args': {'name': name}}]
+        trace += [dict(e, pid=k) for e in p.events]
+        rows = p.summary()
+        results[name] = {x: sum(r[x] for r in rows) for x in ('params', 'GFLOPs', 'ms', 'output MB')}
+
+    with open(save_dir / 'trace.json', 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+    print(('\n%30s' + '%14s' * 4) % ('cfg', 'params', 'GFLOPs/img', 'ms/batch', 'output MB/img'))
+    for name, r in results.items():
+        print(f"{name:>30s}{r['params']:14d}{r['GFLOPs']:14.2f}{r['ms']:14.2f}{r['output MB']:14.2f}")
+    print(f'Results saved to {save_dir}')
+    return results
+
+
+def deploy(cfgs, imgsz=640, batch_size=1, device='cpu', n=20, warmup=3):
+    # Fused model latency with NCHW or channels-last (NHWC) weights and inputs, under torch.no_grad() or
+    # torch.inference_mode(), and the largest output difference to NCHW under torch.no_grad()
+    device = select_device(device, batch_size=batch_size)
+    modes = [(nhwc, im) for im in (False, True) for nhwc in (False, True)]
+    names = [('NHWC' if nhwc else 'NCHW') + (' inference' if im else ' no_grad') for nhwc, im in modes]
+    results = {}
+    print(('%30s' + '%20s' * len(modes) + '%12s') % ('cfg', *[f'{s} ms' for s in names], 'max diff'))
+    for cfg in cfgs:
+        with torch.no_grad():
+            model = Model(cfg).to(device).fuse().eval()
+        x = torch.rand(batch_size, 3, imgsz, imgsz, device=device)
+        times, outputs = [], []
+        for nhwc, im in modes:
+            memory_format = torch.channels_last if nhwc else torch.contiguous_format
+            m, xm = deepcopy(model).to(memory_format=memory_format), x.contiguous(memory_format=memory_format)
+            with inference_mode(im):
+                for _ in range(warmup):
+                    m(xm)
+                t = time_synchronized()
+                for _ in range(n):
+                    y = m(xm)[0]
+                times.append((time_synchronized() - t) / n * 1E3)
+            outputs.append(y.clone())
+        diff = max((y - outputs[0]).abs().max().item() for y in outputs)
+        results[cfg] = dict(zip(names, times)), diff
+        print(('%30s' + '%20.1f' * len(modes) + '%12.3g') % (Path(cfg).name, *times, diff))
+    return results
+
+
+def load(weights, imgsz=640, device='cpu', n=10):
+    # attempt_load() time of a *.pt checkpoint vs. its fused, memory-mapped *.safetensors export (written if missing),
+    # time to the first inference result and the largest output difference
+    device = select_device(device)
+    f = str(Path(weights).with_suffix('.safetensors'))
+    if not os.path.exists(f):
+        save_fused(attempt_load(weights, map_location='cpu'), f)
+    x = torch.rand(1, 3, imgsz, imgsz, device=device)
+    results, outputs = {}, []
+    print(('%40s' + '%12s' * 4) % ('weights', 'size MB', 'load ms', 'first ms', 'max diff'))
+    for w in weights, f:
+        tl, tf = [], []
+        for _ in range(n):
+            t = time_synchronized()
+            model = attempt_load(w, map_location=device)
+            tl.append(time_synchronized() - t)
+            with torch.no_grad():
+                y = model(x)[0]
+            tf.append(time_synchronized() - t)
+        outputs.append(y)
+        results[w] = os.path.getsize(w) / 1E6, np.median(tl) * 1E3, np.median(tf) * 1E3
+        print(('%40s' + '%12.1f' * 3 + '%12.3g') % (w, *results[w], (y - outputs[0]).abs().max().item()))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('--task', default='mosaic', help='mosaic, dataloader, ap, memory, tta, layers, deploy, load or ensemble')
+    parser.add_argument('--data', type=str, default='data/coco.yaml', help='*.data path')
+    parser.add_argument('--cfg', nargs='+', default=sorted(glob.glob('cfg/deploy/*.yaml')), help='model.yaml path(s) for --task memory, layers or deploy')
+    parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or cpu, for --task memory, tta, layers or deploy')
+    parser.add_argument('--weights', nargs='+', type=str, default=['yolov7.pt'], help='model.pt path(s) for --task tta, load or ensemble')
+    parser.add_argument('--hyp', type=str, default='data/hyp.scratch.p5.yaml', help='hyperparameters path')
+    parser.add_argument('--split', default='train', help='dataset split for --task dataloader, train or val')
+    parser.add_argument('--img-size', type=int, default=640, help='train image size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=16, help='dataloader batch size')
+    parser.add_argument('--workers', type=int, default=8, help='maximum number of dataloader workers')
+    parser.add_argument('--n', type=int, default=300, help='number of timed samples (mosaic), batches (dataloader) or 1000s of predictions (ap)')
+    parser.add_argument('--no-cache', action='store_true', help='read images from disk instead of caching in RAM')
+    parser.add_argument('--no-augment', action='store_true', help='disable augmentation (validation pipeline)')
+    parser.add_argument('--fused-augment', action='store_true', help='apply perspective and flips in a single warp')
+    parser.add_argument('--save-dir', default='runs/layers', help='CSV, JSON and trace directory for --task layers')
+    opt = parser.parse_args()
+    opt.data, opt.hyp = check_file(opt.data), check_file(opt.hyp)  # check files
+    set_logging()
+    print(opt)
+
+    if opt.task == 'mosaic':  # mosaic assembly throughput
+        mosaic(opt.data, opt.hyp, opt.img_size, opt.n, cache=not opt.no_cache)
+
+    elif opt.task == 'dataloader':  # batches/s out of create_dataloader()
+        dataloader(opt.data, opt.hyp, opt.img_size, opt.batch_size, opt.workers, opt.n, cache=not opt.no_cache,
+                   augment=not opt.no_augment, fused_augment=opt.fused_augment, task=opt.split)
+
+    elif opt.task == 'ap':  # mAP computation time vs. number of classes
+        ap(n=opt.n * 1000)
+
+    elif opt.task == 'memory':  # peak inference activation memory per model
+        memory(opt.cfg, opt.img_size, opt.batch_size, opt.device)
+
+    elif opt.task == 'tta':  # test-time augmentation accuracy vs. latency
+        tta(opt.data, opt.weights[0], opt.img_size, opt.batch_size, opt.device)
+
+    elif opt.task == 'layers':  # per layer profile of each model over val set batches
+        layers(opt.cfg, opt.data, opt.img_size, opt.batch_size, opt.device, opt.n, save_dir=opt.save_dir)
+
+    elif opt.task == 'deploy':  # channels-last and inference mode latency per model
+        deploy(opt.cfg, opt.img_size, opt.batch_size, opt.device, opt.n)
+
+    elif opt.task == 'load':  # checkpoint vs. fused memory-mapped weights load time
+        load(opt.weights[0], opt.img_size, opt.device, opt.n)
+
+    elif opt.task == 'ensemble':  # sequential vs. concurrent ensemble latency, NMS vs. weighted box fusion mAP
+        ensemble(opt.data, opt.weights, opt.img_size, opt.batch_size, opt.device, opt.n)
@@ -10,7 +10,7 @@ import torch.nn as nn
 from torch.utils.mobile_optimizer import optimize_for_mobile
 
 import models
-from models.experimental import attempt_load, End2End
+from models.experimental import attempt_load, save_fused, End2End
 from utils.activations import Hardswish, SiLU
 from utils.general import set_logging, check_img_size
 from utils.torch_utils import select_device
@@ -34,6 +34,7 @@ if __name__ == '__main__':
     parser.add_argument('--include-nms', action='store_true', help='export end2end onnx')
     parser.add_argument('--fp16', action='store_true', help='CoreML FP16 half-precision export')
     parser.add_argument('--int8', action='store_true', help='CoreML INT8 quantization')
+    parser.add_argument('--safetensors', action='store_true', help='also export fused memory-mapped safetensors weights')
     opt = parser.parse_args()
     opt.img_size *= 2 if len(opt.img_size) == 1 else 1  # expand
     opt.dynamic = opt.dynamic and not opt.end2end
@@ -47,6 +48,16 @@ if __name__ == '__main__':
     model = attempt_load(opt.weights, map_location=device)  # load FP32 model
     labels = model.names
 
+    # Fused weights export, before export-specific model updates
+    if opt.safetensors:
+        try:
+            print('\nStarting fused safetensors export with torch %s...' % torch.__version__)
+            f = opt.weights.replace('.pt', '.safetensors')  # filename
+            save_fused(model, f)
+            print('Fused safetensors export success, saved as %s' % f)
+        except Exception as e:
+            print('Fused safetensors export failure: %s' % e)
+
     # Checks
     gs = int(max(model.stride))  # grid size (max stride)
     opt.img_size = [check_img_size(x, gs) for x in opt.img_size]  # verify img_size are gs-multiples
@@ -15,7 +15,7 @@ from torch.cuda import amp
 from utils.datasets import letterbox
 from utils.general import non_max_suppression, make_divisible, scale_coords, increment_path, xyxy2xywh
 from utils.plots import color_list, plot_one_box
-from utils.torch_utils import time_synchronized
+from utils.torch_utils import time_synchronized, inference_mode
 
 
 ##### basic ####
@@ -867,6 +867,7 @@ class autoShape(nn.Module):
     conf = 0.25  # NMS confidence threshold
     iou = 0.45  # NMS IoU threshold
     classes = None  # (optional list) filter by class
+    inference = False  # run under torch.inference_mode(), results can then not be modified in place outside of it
 
     def __init__(self, model):
         super(autoShape, self).__init__()
@@ -876,7 +877,6 @@ class autoShape(nn.Module):
         print('autoShape already enabled, skipping... ')  # model already converted to model.autoshape()
         return self
 
-    @torch.no_grad()
     def forward(self, imgs, size=640, augment=False, profile=False):
         # Inference from various sources. For height=640, width=1280, RGB images example inputs are:
         #   filename:   imgs = 'data/samples/zidane.jpg'
@@ -886,12 +886,18 @@ class autoShape(nn.Module):
         #   numpy:           = np.zeros((640,1280,3))  # HWC
         #   torch:           = torch.zeros(16,3,320,640)  # BCHW (scaled to size=640, 0-1 values)
         #   multiple:        = [Image.open('image1.jpg'), Image.open('image2.jpg'), ...]  # list of images
+        with inference_mode(self.inference):  # torch.no_grad() unless inference
+            return self._forward(imgs, size, augment, profile)
 
+    def _forward(self, imgs, size, augment, profile):
         t = [time_synchronized()]
         p = next(self.model.parameters())  # for device and type
+        nhwc = p.dim() == 4 and p.is_contiguous(memory_format=torch.channels_last) and not p.is_contiguous()
+        memory_format = torch.channels_last if nhwc else torch.contiguous_format  # inputs as the weights
         if isinstance(imgs, torch.Tensor):  # torch
             with amp.autocast(enabled=p.device.type != 'cpu'):
-                return self.model(imgs.to(p.device).type_as(p), augment, profile)  # inference
+                return self.model(imgs.to(p.device).type_as(p).contiguous(memory_format=memory_format), augment,
+                                  profile)  # inference
 
         # Pre-process
         n, imgs = (len(imgs), imgs) if isinstance(imgs, list) else (1, [imgs])  # number of images, list of images
@@ -915,7 +921,7 @@ class autoShape(nn.Module):
         x = [letterbox(im, new_shape=shape1, auto=False)[0] for im in imgs]  # pad
         x = np.stack(x, 0) if n > 1 else x[0][None]  # stack
         x = np.ascontiguousarray(x.transpose((0, 3, 1, 2)))  # BHWC to BCHW
-        x = torch.from_numpy(x).to(p.device).type_as(p) / 255.  # uint8 to fp16/32
+        x = (torch.from_numpy(x).to(p.device).type_as(p) / 255.).contiguous(memory_format=memory_format)  # to fp16/32
         t.append(time_synchronized())
 
         with amp.autocast(enabled=p.device.type != 'cpu'):
@@ -1,10 +1,17 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from copy import deepcopy
+
 import numpy as np
 import random
 import torch
 import torch.nn as nn
 
 from models.common import Conv, DWConv
+from utils.general import non_max_suppression, weighted_boxes_fusion, xyxy2xywh
 from utils.google_utils import attempt_download
+from utils.torch_utils import inference_mode, load_tensors, save_tensors
 
 
 class CrossConv(nn.Module):
@@ -67,19 +74,80 @@ class MixConv2d(nn.Module):
 
 
 class Ensemble(nn.ModuleList):
-    # Ensemble of models
-    def __init__(self):
+    # Ensemble of models. With parallel members run concurrently (see forward_parallel()), fusion is 'nms' of their
+    # concatenated predictions or 'wbf' weighted box fusion of their detections, with optional member weights
+    def __init__(self, parallel=False, fusion='nms', weights=None, conf=0.001, iou=0.55):
         super(Ensemble, self).__init__()
+        assert fusion in ('nms', 'wbf'), f'unknown ensemble fusion {fusion}, use nms or wbf'
+        assert weights is None or fusion == 'wbf', 'ensemble member weights require fusion=wbf'
+        self.parallel = parallel  # run members concurrently
+        self.fusion = fusion
+        self.weights = weights  # member weights for fusion='wbf', None for equal weights
+        self.conf = conf  # member NMS confidence threshold for fusion='wbf'
+        self.iou = iou  # member NMS and box fusion IoU threshold for fusion='wbf'
+        self.pool, self.streams = None, None  # forward_parallel() threads and CUDA streams, created on first use
+
+    def __getstate__(self):  # deepcopy() and pickle without threads and streams
+        state = self.__dict__.copy()
+        state['pool'], state['streams'] = None, None
+        return state
 
     def forward(self, x, augment=False):
-        y = []
-        for module in self:
-            y.append(module(x, augment)[0])
+        if self.parallel and len(self) > 1:
+            y = self.forward_parallel(x, augment)
+        else:
+            y = [module(x, augment)[0] for module in self]
+        if self.fusion == 'wbf':
+            return self.wbf(y), None
         # y = torch.stack(y).max(0)[0]  # max ensemble
         # y = torch.stack(y).mean(0)  # mean ensemble
         y = torch.cat(y, 1)  # nms ensemble
         return y, None  # inference, train output
 
+    def forward_parallel(self, x, augment=False):
+        # Member predictions with one thread per member, and one CUDA stream per member on GPU. PyTorch releases the GIL
+        # in its kernels, so members overlap. Members run without autograd, in inference mode and autocast (CUDA mixed
+        # precision) if the caller is, as these are thread-local
+        inference = getattr(torch, 'is_inference_mode_enabled', lambda: False)()
+        autocast = torch.is_autocast_enabled()
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(len(self))
+        if not x.is_cuda:
+            streams = [None] * len(self)
+        else:
+            if self.streams is None or self.streams[0].device != x.device:
+                self.streams = [torch.cuda.Stream(x.device) for _ in self]
+            streams, current = self.streams, torch.cuda.current_stream(x.device)
+            for s in streams:
+                s.wait_stream(current)  # x ready
+
+        def run(module, stream):
+            amp = (torch.autocast('cuda') if hasattr(torch, 'autocast') else torch.cuda.amp.autocast()) if autocast \
+                else nullcontext()
+            with inference_mode(inference), amp, torch.cuda.stream(stream):
+                return module(x, augment)[0]
+
+        y = list(self.pool.map(run, self, streams))
+        if x.is_cuda:
+            for s, yi in zip(streams, y):
+                current.wait_stream(s)
+                yi.record_stream(current)  # used on the current stream, allocated on s
+        return y
+
+    def wbf(self, y):
+        # Weighted box fusion of member NMS detections, returned as (batch, n, 5 + nc) predictions (fused boxes with
+        # one-hot classes) to keep the usual non_max_suppression() of ensemble outputs
+        nc = y[0].shape[2] - 5  # number of classes
+        detections = [non_max_suppression(yi, self.conf, self.iou, multi_label=True) for yi in y]
+        fused = [weighted_boxes_fusion(d, self.weights, self.iou) for d in zip(*detections)]
+        out = y[0].new_zeros(len(fused), max(len(f) for f in fused), nc + 5)
+        for i, f in enumerate(fused):
+            n = len(f)
+            out[i, :n, :4] = xyxy2xywh(f[:, :4])
+            out[i, :n, 4] = f[:, 4]
+            out[i, torch.arange(n), 5 + f[:, 5].long()] = 1.0
+        return out
+
 
 
 
@@ -244,10 +312,18 @@ class End2End(nn.Module):
 
 
 
-def attempt_load(weights, map_location=None):
-    # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
-    model = Ensemble()
+def attempt_load(weights, map_location=None, channels_last=False, ensemble_parallel=False, fusion='nms',
+                 fusion_weights=None, tta_scales=None):
+    # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a. With channels_last the
+    # fused weights are converted to torch.channels_last (NHWC) memory format, inputs should be converted as well.
+    # Ensembles run their models concurrently with ensemble_parallel and fuse their outputs by fusion 'nms' or 'wbf'
+    # (weighted box fusion, optionally with fusion_weights per model), see Ensemble. tta_scales sets the test-time
+    # augmentation scales of each loaded model
+    model = Ensemble(ensemble_parallel, fusion, fusion_weights)
     for w in weights if isinstance(weights, list) else [weights]:
+        if str(w).endswith('.safetensors'):  # fused weights, see save_fused()
+            model.append(load_fused(w, map_location))
+            continue
         attempt_download(w)
         ckpt = torch.load(w, map_location=map_location)  # load
         model.append(ckpt['ema' if ckpt.get('ema') else 'model'].float().fuse().eval())  # FP32 model
@@ -260,13 +336,52 @@ def attempt_load(weights, map_location=None):
             m.recompute_scale_factor = None  # torch 1.11.0 compatibility
         elif type(m) is Conv:
             m._non_persistent_buffers_set = set()  # pytorch 1.6.0 compatibility
+        if tta_scales and hasattr(m, 'tta_scales'):
+            m.tta_scales = tuple(tta_scales)  # this model only
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
     
     if len(model) == 1:
+        if ensemble_parallel or fusion != 'nms':
+            print('WARNING: ensemble options ignored for a single model')
         return model[-1]  # return model
     else:
+        assert fusion_weights is None or len(fusion_weights) == len(model), \
+            f'{len(fusion_weights)} fusion weights for an ensemble of {len(model)} models'
         print('Ensemble created with %s\n' % weights)
         for k in ['names', 'stride']:
             setattr(model, k, getattr(model[-1], k))
         return model  # return ensemble
 
 
+def save_fused(model, file):
+    # Save a fused FP32 Model (i.e. from attempt_load()) as memory-mappable safetensors with its yaml, names and
+    # strides as metadata, without optimizer, EMA or training state, for attempt_load('*.safetensors')
+    metadata = {'format': 'yolov7-fused', 'yaml': json.dumps(model.yaml), 'names': json.dumps(list(model.names)),
+                'stride': json.dumps(model.stride.tolist())}
+    save_tensors(model.state_dict(), file, metadata)
+
+
+def load_fused(file, map_location=None):
+    # Fused FP32 Model from save_fused() weights (torch>=2.1). Layers are built from the yaml on the meta device and
+    # fused in uninitialized memory, i.e. without initializing weights, then take the memory-mapped tensors of file
+    from models.yolo import Model, parse_model
+    version = tuple(int(x) for x in torch.__version__.split('+')[0].split('.')[:2])
+    assert version >= (2, 1), f'loading {file} requires torch>=2.1 (meta device, assign=True), use the *.pt weights'
+    tensors, metadata = load_tensors(file)
+    assert metadata.get('format') == 'yolov7-fused', f'{file} was not saved by save_fused()'
+    cfg = json.loads(metadata['yaml'])
+
+    model = Model.__new__(Model)  # attributes as in Model.__init__(), without the weight initialization
+    nn.Module.__init__(model)
+    model.traced, model.yaml = False, cfg
+    with torch.device('meta'):
+        model.model, model.save = parse_model(deepcopy(cfg), ch=[cfg.get('ch', 3)])
+    with torch.no_grad():
+        model.to_empty(device='cpu').fuse(verbose=False)  # fused layer structure, values are replaced below
+    model.load_state_dict(tensors, assign=True)
+    model.names, model.nc = json.loads(metadata['names']), cfg['nc']
+    model.stride = model.model[-1].stride = torch.tensor(json.loads(metadata['stride']))
+    model.model[-1].grid = [torch.zeros(1)] * model.model[-1].nl
+    model.requires_grad_(False).eval()
+    return model if map_location is None else model.to(map_location)
@@ -1,6 +1,7 @@
 import argparse
 import logging
 import sys
+import weakref
 from copy import deepcopy
 
 sys.path.append('./')  # to run '$ python *.py' files in subdirectories
@@ -11,13 +12,27 @@ from models.experimental import *
 from utils.autoanchor import check_anchor_order
 from utils.general import make_divisible, check_file, set_logging
 from utils.torch_utils import time_synchronized, fuse_conv_and_bn, model_info, scale_img, initialize_weights, \
-    select_device, copy_attr
+    select_device, copy_attr, LayerProfiler
 from utils.loss import SigmoidBin
 
-try:
-    import thop  # for FLOPS computation
-except ImportError:
-    thop = None
+
+decode_cache = weakref.WeakKeyDictionary()  # {detection layer: {(level, ny, nx, device, dtype): decode constants}}
+
+
+def decode_grid(m, i, y):
+    # Box decode constants of detection layer m at level i for output y: 2 * stride, (grid - 0.5) * stride and
+    # 4 * anchors, cached per (ny, nx, device, dtype) so that multi-resolution inference does not rebuild grids.
+    # Not stored on the layer, so never pickled, and rebuilt when anchor_grid was replaced (.to(), .half(), loading) or
+    # changed in place (autoanchor). Inference tensors have no version counter, only their storage identifies them
+    ny, nx, a = *y.shape[2:4], m.anchor_grid
+    version = (a.data_ptr(), None if hasattr(a, 'is_inference') and a.is_inference() else a._version)
+    cache, key = decode_cache.setdefault(m, {}), (i, ny, nx, y.device, y.dtype)
+    d = cache.get(key)
+    if d is None or d[0] != version:
+        s = float(m.stride[i])
+        d = cache[key] = (version, 2. * s, ((m._make_grid(nx, ny) - 0.5) * s).to(y.device, y.dtype),
+                          (4 * m.anchor_grid[i]).to(y.dtype))
+    return d[1:]
 
 
 class Detect(nn.Module):
@@ -49,13 +64,14 @@ class Detect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
                 y = x[i].sigmoid()
-                if not torch.onnx.is_in_onnx_export():
-                    y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                if not torch.onnx.is_in_onnx_export():  # decode in place
+                    xy_gain, xy_offset, wh_gain = decode_grid(self, i, y)
+                    y[..., 0:2].mul_(xy_gain).add_(xy_offset)  # xy = (2 * y - 0.5 + grid) * stride
+                    y[..., 2:4].square_().mul_(wh_gain)  # wh = (2 * y) ** 2 * anchor
                 else:
+                    if self.grid[i].shape[2:4] != x[i].shape[2:4]:
+                        self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
                     xy, wh, conf = y.split((2, 2, self.nc + 1), 4)  # y.tensor_split((2, 4, 5), 4)  # torch 1.8.0
                     xy = xy * (2. * self.stride[i]) + (self.stride[i] * (self.grid[i] - 0.5))  # new xy
                     wh = wh ** 2 * (4 * self.anchor_grid[i].data)  # new wh
@@ -127,12 +143,10 @@ class IDetect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
-
                 y = x[i].sigmoid()
-                y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                xy_gain, xy_offset, wh_gain = decode_grid(self, i, y)  # decode in place
+                y[..., 0:2].mul_(xy_gain).add_(xy_offset)  # xy = (2 * y - 0.5 + grid) * stride
+                y[..., 2:4].square_().mul_(wh_gain)  # wh = (2 * y) ** 2 * anchor
                 z.append(y.view(bs, -1, self.no))
 
         return x if self.training else (torch.cat(z, 1), x)
@@ -147,14 +161,14 @@ class IDetect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
-
                 y = x[i].sigmoid()
-                if not torch.onnx.is_in_onnx_export():
-                    y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                if not torch.onnx.is_in_onnx_export():  # decode in place
+                    xy_gain, xy_offset, wh_gain = decode_grid(self, i, y)
+                    y[..., 0:2].mul_(xy_gain).add_(xy_offset)  # xy = (2 * y - 0.5 + grid) * stride
+                    y[..., 2:4].square_().mul_(wh_gain)  # wh = (2 * y) ** 2 * anchor
                 else:
+                    if self.grid[i].shape[2:4] != x[i].shape[2:4]:
+                        self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
                     xy, wh, conf = y.split((2, 2, self.nc + 1), 4)  # y.tensor_split((2, 4, 5), 4)  # torch 1.8.0
                     xy = xy * (2. * self.stride[i]) + (self.stride[i] * (self.grid[i] - 0.5))  # new xy
                     wh = wh ** 2 * (4 * self.anchor_grid[i].data)  # new wh
@@ -506,6 +520,10 @@ class IBin(nn.Module):
 
 
 class Model(nn.Module):
+    # Test-time augmentation defaults, override per instance (e.g. attempt_load(tta_scales=...)), not on the class
+    tta_scales = (1, 0.83, 0.67)  # scales, every second one flipped left-right
+    tta_pad = False  # pad TTA views to a common size and run them as one batch, padded grid cells are dropped
+
     def __init__(self, cfg='yolor-csp-c.yaml', ch=3, nc=None, anchors=None):  # model, input channels, number of classes
         super(Model, self).__init__()
         self.traced = False
@@ -580,56 +598,84 @@ class Model(nn.Module):
 
     def forward(self, x, augment=False, profile=False):
         if augment:
-            img_size = x.shape[-2:]  # height, width
-            s = [1, 0.83, 0.67]  # scales
-            f = [None, 3, None]  # flips (2-ud, 3-lr)
-            y = []  # outputs
-            for si, fi in zip(s, f):
-                xi = scale_img(x.flip(fi) if fi else x, si, gs=int(self.stride.max()))
-                yi = self.forward_once(xi)[0]  # forward
-                # cv2.imwrite(f'img_{si}.jpg', 255 * xi[0].cpu().numpy().transpose((1, 2, 0))[:, :, ::-1])  # save
-                yi[..., :4] /= si  # de-scale
-                if fi == 2:
-                    yi[..., 1] = img_size[0] - yi[..., 1]  # de-flip ud
-                elif fi == 3:
-                    yi[..., 0] = img_size[1] - yi[..., 0]  # de-flip lr
-                y.append(yi)
-            return torch.cat(y, 1), None  # augmented inference, train
+            return self.forward_augment(x), None  # augmented inference, train
         else:
             return self.forward_once(x, profile)  # single-scale inference, train
 
+    def forward_augment(self, x):
+        # Test-time augmentation over tta_scales. Views of equal shape run as one batch, with tta_pad all views are
+        # padded (bottom-right, so coordinates are unchanged) to the largest and run as a single batch, predictions of
+        # grid cells in the padding are dropped so that each view gives as many as unpadded
+        img_size, bs = x.shape[-2:], x.shape[0]  # height, width
+        s = self.tta_scales  # scales
+        f = [3 if i % 2 else None for i in range(len(s))]  # flips (2-ud, 3-lr)
+        views = [scale_img(x.flip(fi) if fi else x, si, gs=int(self.stride.max())) for si, fi in zip(s, f)]
+        shapes = [v.shape[2:] for v in views]  # unpadded view shapes
+        h, w = max(v.shape[2] for v in views), max(v.shape[3] for v in views)
+        if self.tta_pad:
+            views = [F.pad(v, [0, w - v.shape[3], 0, h - v.shape[2]], value=0.447) for v in views]  # imagenet mean
+        groups = {}  # view shape: view indices
+        for i, v in enumerate(views):
+            groups.setdefault(v.shape[2:], []).append(i)
+
+        y = [None] * len(views)  # outputs
+        for k in groups.values():
+            for i, yi in zip(k, self.forward_once(torch.cat([views[i] for i in k]))[0].split(bs)):  # forward
+                if shapes[i] != views[i].shape[2:]:  # padded, predictions of grid cells inside the view only
+                    yi = yi[:, self.unpadded(views[i].shape[2:], shapes[i]).to(yi.device)]
+                yi[..., :4] /= s[i]  # de-scale
+                if f[i] == 2:
+                    yi[..., 1] = img_size[0] - yi[..., 1]  # de-flip ud
+                elif f[i] == 3:
+                    yi[..., 0] = img_size[1] - yi[..., 0]  # de-flip lr
+                y[i] = yi
+        return torch.cat(y, 1)
+
+    def unpadded(self, shape, crop):
+        # Mask of the detection outputs (per level, anchor and grid cell) of an input of shape whose top-left crop
+        # (multiples of the max stride) is the image and the rest padding, True for grid cells inside the crop
+        na, mask = self.model[-1].na, []
+        for st in self.stride.int().tolist():
+            ny, nx = shape[0] // st, shape[1] // st
+            cells = (torch.arange(ny) < crop[0] // st).view(-1, 1) & (torch.arange(nx) < crop[1] // st)
+            mask.append(cells.expand(na, ny, nx).reshape(-1))
+        return torch.cat(mask)
+
     def forward_once(self, x, profile=False):
-        y, dt = [], []  # outputs
-        for m in self.model:
-            if m.f != -1:  # if not from previous layer
-                x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
-
-            if not hasattr(self, 'traced'):
-                self.traced=False
-
-            if self.traced:
-                if isinstance(m, Detect) or isinstance(m, IDetect) or isinstance(m, IAuxDetect) or isinstance(m, IKeypoint):
-                    break
-
-            if profile:
-                c = isinstance(m, (Detect, IDetect, IAuxDetect, IBin))
-                o = thop.profile(m, inputs=(x.copy() if c else x,), verbose=False)[0] / 1E9 * 2 if thop else 0  # FLOPS
-                for _ in range(10):
-                    m(x.copy() if c else x)
-                t = time_synchronized()
-                for _ in range(10):
-                    m(x.copy() if c else x)
-                dt.append((time_synchronized() - t) * 100)
-                print('%10.1f%10.0f%10.1fms %-40s' % (o, m.np, dt[-1], m.type))
+        if profile:  # print per layer statistics of this forward pass, see LayerProfiler for aggregation and export
+            with LayerProfiler(self) as p:
+                x = self.forward_once(x)
+            p.print()
+            return x
 
-            x = m(x)  # run
-            
-            y.append(x if m.i in self.save else None)  # save output
+        y = [None] * len(self.model)  # outputs, each kept until its last consumer has run
+        for m, (f, keep, free, stop) in zip(self.model, self.execution_plan()):
+            if f != -1:  # if not from previous layer
+                x = y[f] if isinstance(f, int) else [x if j == -1 else y[j] for j in f]  # from earlier layers
+
+            if stop:  # traced, return the detection head inputs
+                break
 
-        if profile:
-            print('%.1fms total' % sum(dt))
+            x = m(x)  # run
+            if keep:
+                y[m.i] = x  # save output
+            for j in free:
+                y[j] = None  # last consumer has run
         return x
 
+    def execution_plan(self):
+        # Static routing table of forward_once(), built once per model and traced state. Per layer: 'from' index
+        # (-1 previous layer, int or list with -1 for the previous layer), whether a later layer reads its output,
+        # outputs not read after it runs, and whether forward stops there (before the head of a traced model)
+        traced = getattr(self, 'traced', False)  # models pickled before TracedModel lack the attribute
+        if getattr(self, '_plan', (None,))[0] is not traced:
+            heads = [i for i, m in enumerate(self.model) if isinstance(m, (Detect, IDetect, IAuxDetect, IKeypoint))]
+            stop = heads[0] if traced and heads else None  # inputs of the first head are the traced outputs
+            routes, last = activation_lifetimes(self.model[:None if stop is None else stop + 1])
+            free = [tuple(j for j, k in last.items() if k == i) for i in range(len(routes))]
+            self._plan = traced, tuple((f, i in last, free[i], i == stop) for i, f in enumerate(routes))
+        return self._plan[1]
+
     def _initialize_biases(self, cf=None):  # initialize biases into Detect(), cf is class frequency
         # https://arxiv.org/abs/1708.02002 section 3.3
         # cf = torch.bincount(torch.tensor(np.concatenate(dataset.labels, 0)[:, 0]).long(), minlength=nc) + 1.
@@ -690,7 +736,7 @@ class Model(nn.Module):
     #         if type(m) is Bottleneck:
     #             print('%10.3g' % (m.w.detach().sigmoid() * 2))  # shortcut weights
 
-    def fuse(self):  # fuse model Conv2d() + BatchNorm2d() layers
+    def fuse(self, verbose=True):  # fuse model Conv2d() + BatchNorm2d() layers
         print('Fusing layers... ')
         for m in self.model.modules():
             if isinstance(m, RepConv):
@@ -706,7 +752,8 @@ class Model(nn.Module):
             elif isinstance(m, (IDetect, IAuxDetect)):
                 m.fuse()
                 m.forward = m.fuseforward
-        self.info()
+        if verbose:
+            self.info()
         return self
 
     def nms(self, mode=True):  # add or remove NMS module
@@ -813,6 +860,23 @@ def parse_model(d, ch):  # model_dict, input_channels(3)
     return nn.Sequential(*layers), sorted(save)
 
 
+def activation_lifetimes(layers):
+    # Liveness analysis of the parse_model() 'from' graph. Returns the inputs of each layer as absolute layer indices,
+    # -1 for the previous layer's output which forward_once() holds anyway, and the last consumer of every output
+    # that is read through its index, i.e. the layer after which that output can be freed
+    routes, last = [], {}  # per layer inputs, {layer: last consumer}
+    for i, m in enumerate(layers):
+        if isinstance(m.f, int):
+            f = m.f if m.f == -1 else m.f % i
+        else:
+            f = [j if j == -1 else j % i for j in m.f]
+        for j in [f] if isinstance(f, int) else f:
+            if j != -1:
+                last[j] = i
+        routes.append(f)
+    return routes, last
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cfg', type=str, default='yolor-csp-c.yaml', help='model.yaml')
@@ -0,0 +1,226 @@
+import argparse
+import re
+from copy import deepcopy
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+import yaml
+
+import test  # test.py
+from models.common import Concat, Conv, MP, RepConv, Shortcut, SP, SPPCSPC
+from models.yolo import Detect, IAuxDetect, IDetect, Model
+from utils.datasets import create_dataloader
+from utils.general import check_file, check_img_size, colorstr, set_logging
+from utils.torch_utils import LayerProfiler, time_synchronized
+
+heads = Detect, IDetect, IAuxDetect  # take any subset of their input channels
+routes = Concat, Shortcut, MP, SP, nn.Upsample, nn.MaxPool2d  # pass channels on, see channel_plan()
+
+
+def prunable(m):
+    # Layer whose output channels can be removed: a dense Conv or a RepConv without identity branch (c1 != c2 or s > 1)
+    if type(m) is Conv:
+        return m.conv.groups == 1
+    return type(m) is RepConv and m.groups == 1 and getattr(m, 'rbr_identity', None) is None
+
+
+def importance(m):
+    # Output channel importance of a prunable layer, BN scaling factors (network slimming) or L1 filter norms if fused
+    if type(m) is RepConv:
+        if hasattr(m, 'rbr_reparam'):
+            return m.rbr_reparam.weight.detach().abs().sum((1, 2, 3))
+        return m.rbr_dense[1].weight.detach().abs() + m.rbr_1x1[1].weight.detach().abs()
+    if isinstance(getattr(m, 'bn', None), nn.BatchNorm2d):
+        return m.bn.weight.detach().abs()
+    return m.conv.weight.detach().abs().sum((1, 2, 3))
+
+
+def channel_plan(model, ratio=0.3, divisor=8, imgsz=256):
+    # Kept output channels of every layer when removing the least important ratio of channels of each prunable layer,
+    # rounded to multiples of divisor. Channels are removed consistently across the parse_model() graph: Concat
+    # outputs keep the kept channels of their inputs, MP/SP/Upsample theirs, layers added by a Shortcut share one
+    # choice, and a layer is only pruned if every consumer (possibly through Concat etc.) takes any subset of channels.
+    # Returns per layer kept output channel indices (None for all) and input layers (None for the image)
+    layers = model.model
+    ch = []  # output channels
+    hooks = [m.register_forward_hook(lambda m, x, y: ch.append(y.shape[1] if isinstance(y, torch.Tensor) else 0))
+             for m in layers]
+    with torch.no_grad():
+        model.eval()(torch.zeros(1, 3, imgsz, imgsz, device=next(model.parameters()).device))
+    for h in hooks:
+        h.remove()
+
+    inputs = [[j % i for j in ([m.f] if isinstance(m.f, int) else m.f)] if i else [None] for i, m in enumerate(layers)]
+    consumers = [[] for _ in layers]
+    for i, f in enumerate(inputs):
+        for j in f:
+            if j is not None:
+                consumers[j].append(i)
+
+    def adapts(i):  # layer i takes any subset of its input channels
+        m = layers[i]
+        if isinstance(m, routes):
+            return all(adapts(c) for c in consumers[i])
+        return prunable(m) or type(m) is SPPCSPC or type(m) in heads
+
+    def source(i):  # single prunable layer whose channels layer i outputs, if any
+        m = layers[i]
+        if prunable(m):
+            return i
+        if isinstance(m, (Shortcut, MP, SP, nn.Upsample, nn.MaxPool2d)):
+            return source(inputs[i][0])
+        return None
+
+    # Layers added by a Shortcut are pruned as one group (union-find), not at all if any of them cannot be pruned
+    parent = {i: i for i, m in enumerate(layers) if prunable(m) and all(adapts(c) for c in consumers[i])}
+    find = lambda i: i if parent[i] == i else find(parent[i])
+    fixed = set()
+    for i, m in enumerate(layers):
+        if isinstance(m, Shortcut):
+            s = [source(j) for j in inputs[i]]
+            if all(j in parent for j in s):
+                parent[find(s[0])] = find(s[1])
+            else:
+                fixed.update(s)
+    groups = {}
+    for i in parent:
+        groups.setdefault(find(i), []).append(i)
+    groups = [g for g in groups.values() if not fixed.intersection(g)]
+
+    keep = [None] * len(layers)
+    for g in groups:
+        n = ch[g[0]]
+        k = min(max(round(n * (1 - ratio) / divisor) * divisor, divisor), n)
+        if k < n and n % divisor == 0:
+            score = sum(importance(layers[i]) for i in g)
+            kept = score.argsort(descending=True)[:k].sort()[0].cpu()
+            for i in g:
+                keep[i] = kept
+
+    # Propagate through Concat and channel-wise layers
+    for i, m in enumerate(layers):
+        if isinstance(m, Concat):
+            kept, offset = [], 0
+            for j in inputs[i]:
+                kept.append((torch.arange(ch[j]) if keep[j] is None else keep[j]) + offset)
+                offset += ch[j]
+            keep[i] = None if all(keep[j] is None for j in inputs[i]) else torch.cat(kept)
+        elif isinstance(m, routes):
+            keep[i] = keep[inputs[i][0]]
+    return keep, inputs
+
+
+def prune(model, ratio=0.3, divisor=8):
+    # Structured channel pruning of a Model, returns a smaller Model built from its pruned yaml with copied weights
+    assert model.yaml['width_multiple'] == 1.0, 'channel pruning requires width_multiple: 1.0'
+    keep, inputs = channel_plan(model, ratio, divisor)
+    cfg = deepcopy(model.yaml)
+    for m, k, layer in zip(model.model, keep, cfg['backbone'] + cfg['head']):
+        if k is not None and prunable(m):
+            layer[3][0] = len(k)  # output channels
+    pruned = Model(cfg, ch=cfg.get('ch', 3)).to(next(model.parameters()).device)
+
+    with torch.no_grad():
+        for mo, mn, k, f in zip(model.model, pruned.model, keep, inputs):
+            sd = mo.state_dict()
+            ins = [None if j is None else keep[j] for j in f]
+            for name, v in mn.state_dict().items():
+                w = sd[name]
+                if w.shape != v.shape:
+                    if w.shape[0] != v.shape[0]:  # output channels
+                        w = w[k]
+                    if w.shape[1:2] != v.shape[1:2]:  # input channels, per input of detection layers
+                        j = re.match(r'(m|m2|ia)\.(\d+)\.', name) if type(mo) in heads else None
+                        j = 0 if j is None else int(j[2]) + (mo.nl if j[1] == 'm2' else 0)
+                        w = w[:, ins[j]]
+                v.copy_(w)
+            if hasattr(mn, 'ia') and 'forward' not in vars(mo):  # unfused IDetect, fold removed ImplicitA into bias
+                for j, (m, a) in enumerate(zip(mo.m, mo.ia)):
+                    if ins[j] is not None:
+                        removed = torch.ones(m.in_channels, dtype=torch.bool)
+                        removed[ins[j]] = False
+                        mn.m[j].bias += m.weight[:, removed, 0, 0] @ a.implicit[0, removed, 0, 0]
+    for k in 'names', 'nc', 'hyp', 'gr':
+        if hasattr(model, k):
+            setattr(pruned, k, getattr(model, k))
+    return pruned
+
+
+def save_yaml(cfg, file):
+    # Model yaml in the layout of cfg/, one [from, number, module, args] layer per line
+    with open(file, 'w') as f:
+        yaml.safe_dump({k: v for k, v in cfg.items() if k not in ('backbone', 'head')}, f, sort_keys=False,
+                       default_flow_style=None)
+        i = 0
+        for k in 'backbone', 'head':
+            f.write(f'\n{k}:\n')
+            for layer in cfg[k]:
+                f.write(f'  - {yaml.safe_dump(layer, default_flow_style=True, width=float("inf")).strip()}  # {i}\n')
+                i += 1
+
+
+def latency(model, imgsz=640, n=10):
+    # Mean batch size 1 inference time in ms
+    x = torch.zeros(1, 3, imgsz, imgsz, device=next(model.parameters()).device)
+    with torch.no_grad():
+        model(x)  # warmup
+        t = time_synchronized()
+        for _ in range(n):
+            model(x)
+    return (time_synchronized() - t) / n * 1E3
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='prune.py')
+    parser.add_argument('--weights', type=str, default='yolov7.pt', help='model.pt path')
+    parser.add_argument('--ratio', nargs='+', type=float, default=[0.3], help='fraction of channels to remove per layer')
+    parser.add_argument('--divisor', type=int, default=8, help='kept channels are multiples of divisor')
+    parser.add_argument('--data', type=str, default='', help='*.data path for mAP, skipped if empty')
+    parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=16, help='test batch size')
+    parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or cpu')
+    opt = parser.parse_args()
+    set_logging()
+    print(opt)
+
+    device = torch.device('cpu' if opt.device == 'cpu' else f'cuda:{opt.device}')
+    ckpt = torch.load(opt.weights, map_location=device)
+    model = ckpt['ema' if ckpt.get('ema') else 'model'].float().eval()  # unfused, BN scaling factors are importances
+    imgsz = check_img_size(opt.img_size, s=max(int(model.stride.max()), 32))
+    if opt.data:
+        opt.data = check_file(opt.data)
+        with open(opt.data) as f:
+            data = yaml.load(f, Loader=yaml.SafeLoader)
+        loader = create_dataloader(data['val'], imgsz, opt.batch_size, max(int(model.stride.max()), 32),
+                                   argparse.Namespace(single_cls=False), pad=0.5, rect=True,
+                                   prefix=colorstr('val: '))[0]
+
+    results = []
+    for ratio in [0] + opt.ratio:
+        m = model if ratio == 0 else prune(model, ratio, opt.divisor)
+        if ratio:  # pruned yaml and weights (checkpoint for train.py --weights ... --cfg ...)
+            f = Path(opt.weights).with_suffix('')
+            f = f.with_name(f'{f.name}_pruned{round(ratio * 100)}')
+            save_yaml(m.yaml, f.with_suffix('.yaml'))
+            torch.save({'epoch': -1, 'best_fitness': None, 'training_results': None,
+                        'model': deepcopy(m).half().requires_grad_(False), 'optimizer': None, 'wandb_id': None},
+                       f.with_suffix('.pt'))
+            print(f'Saved {f}.yaml and {f}.pt')
+
+        with torch.no_grad():
+            fused = deepcopy(m).fuse().eval()
+        with LayerProfiler(fused) as p, torch.no_grad():
+            fused(torch.zeros(1, 3, imgsz, imgsz, device=device))
+        r = [ratio, sum(x.numel() for x in m.parameters()) / 1E6, sum(x['GFLOPs'] for x in p.summary()),
+             latency(fused, imgsz)]
+        if opt.data:
+            r += test.test(opt.data, batch_size=opt.batch_size, imgsz=imgsz, model=fused, dataloader=loader,
+                           plots=False)[0][2:4]
+        results.append(r)
+
+    print(('%10s' + '%12s' * (len(results[0]) - 1)) % ('pruned', 'params M', 'GFLOPs', 'latency ms', 'mAP@.5',
+                                                       'mAP@.5:.95')[:len(results[0])])
+    for r in results:
+        print(('%10.0f%%' + '%11.2f' + '%12.2f' * 2 + '%12.4g' * (len(r) - 4)) % (r[0] * 100, *r[1:]))
+    print('Fine-tune pruned models with train.py --weights *_pruned*.pt --cfg *_pruned*.yaml')
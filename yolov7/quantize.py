@@ -0,0 +1,71 @@
+import argparse
+import os
+import random
+from pathlib import Path
+
+import torch
+import yaml
+
+import test  # test.py
+from models.experimental import attempt_load
+from utils.datasets import LoadImagesAndLabels, create_dataloader
+from utils.general import check_file, check_img_size, colorstr, set_logging
+from utils.torch_utils import QuantizedModel
+
+
+def calibration_batches(path, imgsz=640, batch_size=16, n=256, stride=32):
+    # Float image batches of n random, letterboxed, non-augmented images for observer calibration
+    dataset = LoadImagesAndLabels(path, imgsz, batch_size, stride=stride, prefix=colorstr('calibration: '))
+    indices = random.Random(0).sample(range(len(dataset)), min(n, len(dataset)))
+    for i in range(0, len(indices), batch_size):
+        yield torch.stack([dataset[j][0] for j in indices[i:i + batch_size]]).float() / 255.0
+
+
+def quantize(weights, data, imgsz=640, batch_size=16, n=256, backend='fbgemm', task='train', evaluate=True):
+    # Post-training static int8 quantization of weights, saved as *_int8.pt (loadable by attempt_load(), test.py and
+    # detect.py --no-trace on CPU), with val set accuracy and latency of the FP32 and int8 models
+    model = attempt_load(weights, map_location='cpu')  # load FP32 model
+    gs = max(int(model.stride.max()), 32)  # grid size (max stride)
+    imgsz = check_img_size(imgsz, s=gs)
+    with open(data) as f:
+        data_dict = yaml.load(f, Loader=yaml.SafeLoader)
+
+    qmodel = QuantizedModel(model, calibration_batches(data_dict[task], imgsz, batch_size, n, gs), backend)
+    f = str(Path(weights).with_suffix('')) + '_int8.pt'
+    torch.save({'model': qmodel}, f)
+    print(f'Saved {f}')
+    if not evaluate:
+        return qmodel, f
+
+    opt = argparse.Namespace(single_cls=False)
+    loader = create_dataloader(data_dict['val'], imgsz, batch_size, gs, opt, pad=0.5, rect=True,
+                               prefix=colorstr('val: '))[0]
+    results = []
+    for name, m, file in ('FP32', model, weights), ('int8', qmodel, f):
+        (mp, mr, map50, map, *_), _, t = test.test(data, batch_size=batch_size, imgsz=imgsz, model=m, dataloader=loader,
+                                                   plots=False)
+        results.append((name, os.path.getsize(file) / 1E6, mp, mr, map50, map, t[0]))
+
+    print(('%10s' + '%12s' * 6) % ('model', 'size MB', 'P', 'R', 'mAP@.5', 'mAP@.5:.95', 'infer ms'))
+    for name, *x in results:
+        print(('%10s' + '%12.1f' + '%12.4g' * 4 + '%12.1f') % (name, *x))
+    print(f'int8 mAP@.5 change {results[1][4] - results[0][4]:+.4g}, speedup {results[0][-1] / results[1][-1]:.2f}x')
+    return qmodel, f
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='quantize.py')
+    parser.add_argument('--weights', type=str, default='yolov7.pt', help='model.pt path')
+    parser.add_argument('--data', type=str, default='data/coco.yaml', help='*.data path')
+    parser.add_argument('--img-size', type=int, default=640, help='calibration and inference size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=16, help='calibration and test batch size')
+    parser.add_argument('--calib', type=int, default=256, help='number of calibration images')
+    parser.add_argument('--task', default='train', help='calibration images from train, val or test')
+    parser.add_argument('--backend', default='fbgemm', help='quantized engine, fbgemm or x86 (x86), qnnpack (ARM)')
+    parser.add_argument('--no-test', action='store_true', help='skip the FP32 vs. int8 accuracy and latency check')
+    opt = parser.parse_args()
+    opt.data = check_file(opt.data)  # check file
+    set_logging()
+    print(opt)
+
+    quantize(opt.weights, opt.data, opt.img_size, opt.batch_size, opt.calib, opt.backend, opt.task, not opt.no_test)
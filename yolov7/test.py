@@ -1,21 +1,122 @@
 import argparse
+import hashlib
 import json
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from threading import Thread
 
 import numpy as np
 import torch
+import torch.distributed as dist
+from torch.nn.utils.rnn import pad_sequence
 import yaml
 from tqdm import tqdm
 
-from models.experimental import attempt_load
-from utils.datasets import create_dataloader
+from models.experimental import Ensemble, attempt_load
+from models.yolo import Model
+from utils.datasets import create_dataloader, get_hash, ShardSampler
 from utils.general import coco80_to_coco91_class, check_dataset, check_file, check_img_size, check_requirements, \
-    box_iou, non_max_suppression, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, increment_path, colorstr
-from utils.metrics import ap_per_class, ConfusionMatrix
-from utils.plots import plot_images, output_to_target, plot_study_txt
-from utils.torch_utils import select_device, time_synchronized, TracedModel
+    non_max_suppression, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, increment_path, colorstr
+from utils.metrics import ap_per_class, match_predictions, APAccumulator, ConfusionMatrix
+from utils.plots import plot_images, output_to_target, plot_study_txt, plot_pool
+from utils.torch_utils import select_device, time_synchronized, StageTimer, TracedModel
+
+
+def save_one_txt(predn, save_conf, shape, file):
+    # Save one image's predictions as normalized xywh labels, in a single write
+    gn = torch.tensor(shape)[[1, 0, 1, 0]]  # normalization gain whwh
+    xywh = (xyxy2xywh(predn[:, :4]) / gn).tolist()  # normalized xywh
+    lines = [(cls, *b, conf) if save_conf else (cls, *b) for (*_, conf, cls), b in zip(predn.tolist(), xywh)]
+    with open(file, 'a') as f:
+        f.write(''.join(('%g ' * len(line)).rstrip() % line + '\n' for line in lines))
+
+
+def save_one_json(pred, predn, image_id, class_map, file, first=False):
+    # Append one image's predictions to a streamed pycocotools JSON list, created by the first image, closed by ']'
+    # [{"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}, ...
+    box = xyxy2xywh(predn[:, :4])  # xywh
+    box[:, :2] -= box[:, 2:] / 2  # xy center to top-left corner
+    with open(file, 'w' if first else 'a') as f:
+        f.write(('[' if first else ', ') + ', '.join(json.dumps({
+            'image_id': image_id,
+            'category_id': class_map[int(p[5])] if class_map else int(p[5]),
+            'bbox': [round(x, 3) for x in b],
+            'score': round(p[4], 5)}) for p, b in zip(pred.tolist(), box.tolist())))
+
+
+def eval_cache_dir(root, weights, dataset, imgsz, batch_size, single_cls, augment, half, ensemble=None):
+    # Raw model outputs cache directory in root, keyed by weights contents, val set fingerprint and settings they depend on
+    h = hashlib.md5()
+    for w in weights if isinstance(weights, list) else [weights]:
+        with open(w, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(str((get_hash(dataset.label_files + dataset.img_files), dataset.img_files, imgsz, batch_size, single_cls,
+                  augment, half, ensemble)).encode())
+    return Path(root) / h.hexdigest()
+
+
+def cached_batches(cache_dir, n):
+    # Recorded batches of an eval cache, loaded one file at a time
+    for i in range(n):
+        yield torch.load(cache_dir / f'batch{i}.pt')
+
+
+def sweep_thresholds(batches, conf_grid, iou_grid, iouv, nc, save_dir=Path(''), v5_metric=False, merge=False, workers=8):
+    # P, R, F1 and mAP for every (conf_thres, iou_thres) combination over cached raw model outputs, streamed one batch at
+    # a time and evaluated for all combinations in parallel
+    device = iouv.device
+
+    def evaluate(out, targets, shapes, height, width, conf_thres, iou_thres):
+        stats = []
+        with torch.no_grad():  # grad mode is per thread
+            out = non_max_suppression(out, conf_thres=conf_thres, iou_thres=iou_thres, multi_label=True, merge=merge)
+            for si, pred in enumerate(out):
+                labels = targets[targets[:, 0] == si, 1:]
+                correct = torch.zeros(pred.shape[0], len(iouv), dtype=torch.bool, device=device)
+                if len(labels) and len(pred):
+                    predn, tbox = pred.clone(), xywh2xyxy(labels[:, 1:5])
+                    scale_coords((height, width), predn[:, :4], shapes[si][0], shapes[si][1])
+                    scale_coords((height, width), tbox, shapes[si][0], shapes[si][1])
+                    correct = match_predictions(predn, torch.cat((labels[:, 0:1], tbox), 1), iouv)
+                stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), labels[:, 0].cpu()))
+        return stats
+
+    def metrics(conf_thres, iou_thres, stats):
+        stats = [torch.cat(x, 0).numpy() for x in zip(*stats)]  # to numpy
+        if not (len(stats) and stats[0].any()):  # no true positives, i.e. no predictions or no labels
+            return conf_thres, iou_thres, 0., 0., 0., 0., 0.
+        tp, conf, pcls, tcls = stats
+
+        # Precision and recall at the operating point, i.e. of all predictions kept at conf_thres, at IoU 0.5
+        pi, ti = pcls.astype(np.int64), tcls.astype(np.int64)
+        c = np.unique(ti)  # classes with labels
+        nt, npred = np.bincount(ti, minlength=nc)[c], np.bincount(pi, minlength=nc)[c]
+        ntp = np.bincount(pi, weights=tp[:, 0], minlength=nc)[c]
+        p, r = ntp / np.maximum(npred, 1), ntp / np.maximum(nt, 1)
+        f1 = 2 * p * r / (p + r + 1e-16)
+        ap = ap_per_class(tp, conf, pcls, tcls, v5_metric=v5_metric)[2]
+        return conf_thres, iou_thres, p.mean(), r.mean(), f1.mean(), ap[:, 0].mean(), ap.mean()
+
+    grid = [(c, i) for c in conf_grid for i in iou_grid]
+    stats = [[] for _ in grid]  # per combination
+    with ThreadPoolExecutor(min(workers, len(grid))) as pool:  # NMS and numpy release the GIL
+        for out, targets, _, shapes, shape in batches:
+            out, targets = out.to(device), targets.to(device)
+            targets[:, 2:] *= torch.tensor([shape[3], shape[2], shape[3], shape[2]], device=device)  # to pixels
+            for x, y in zip(stats, pool.map(lambda g: evaluate(out, targets, shapes, *shape[2:], *g), grid)):
+                x.extend(y)
+        results = list(pool.map(lambda x: metrics(*x[0], x[1]), zip(grid, stats)))
+
+    s = ('%12s' * 7) % ('conf_thres', 'iou_thres', 'P', 'R', 'F1', 'mAP@.5', 'mAP@.5:.95')
+    print(f'\nThreshold sweep, P/R/F1 at the operating point:\n{s}')
+    for x in results:
+        print(('%12.3g' * 7) % x)
+    best = max(results, key=lambda x: x[4])
+    print(f'Best F1 {best[4]:.3g} at conf_thres {best[0]:g}, iou_thres {best[1]:g}')
+    np.savetxt(save_dir / 'sweep.txt', results, fmt='%12.4g', header=s)
+    return results
 
 
 def test(data,
@@ -40,7 +141,16 @@ def test(data,
          half_precision=True,
          trace=False,
          is_coco=False,
-         v5_metric=False):
+         v5_metric=False,
+         ap_bins=0,  # stream statistics into confidence histograms with this many bins, 0 for exact
+         eval_cache=False,  # reuse cached raw model outputs, only rerun NMS and metrics
+         sweep=None,  # (conf_grid, iou_grid) thresholds to evaluate over the same model outputs
+         merge=False,  # merge-NMS (weighted box fusion)
+         tta_scales=None,  # test-time augmentation scales, None for the model's
+         ensemble_parallel=False,  # several weights: run models concurrently
+         ensemble_fusion='nms',  # several weights: 'nms' or 'wbf' weighted box fusion of model outputs
+         ensemble_weights=None,  # several weights: model weights for ensemble_fusion='wbf'
+         latency=False):  # print per batch stage latencies and save them as latency.json
     # Initialize/load model and set device
     training = model is not None
     if training:  # called by train.py
@@ -55,7 +165,8 @@ def test(data,
         (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
         # Load model
-        model = attempt_load(weights, map_location=device)  # load FP32 model
+        model = attempt_load(weights, map_location=device, ensemble_parallel=ensemble_parallel, fusion=ensemble_fusion,
+                             fusion_weights=ensemble_weights, tta_scales=tta_scales)  # load FP32 model
         gs = max(int(model.stride.max()), 32)  # grid size (max stride)
         imgsz = check_img_size(imgsz, s=gs)  # check img_size
         
@@ -96,36 +207,87 @@ def test(data,
     seen = 0
     confusion_matrix = ConfusionMatrix(nc=nc)
     names = {k: v for k, v in enumerate(model.names if hasattr(model, 'names') else model.module.names)}
-    coco91class = coco80_to_coco91_class()
+    class_map = coco80_to_coco91_class() if is_coco else None
     s = ('%20s' + '%12s' * 6) % ('Class', 'Images', 'Labels', 'P', 'R', 'mAP@.5', 'mAP@.5:.95')
     p, r, f1, mp, mr, map50, map, t0, t1 = 0., 0., 0., 0., 0., 0., 0., 0., 0.
     loss = torch.zeros(3, device=device)
-    jdict, stats, ap, ap_class, wandb_images = [], [], [], [], []
-    for batch_i, (img, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
-        img = img.to(device, non_blocking=True)
-        img = img.half() if half else img.float()  # uint8 to fp16/32
-        img /= 255.0  # 0 - 255 to 0.0 - 1.0
-        targets = targets.to(device)
-        nb, _, height, width = img.shape  # batch size, channels, height, width
+    nj, stats, ap, ap_class, wandb_images = 0, [], [], [], []  # nj: number of JSON predictions
+    accumulator = APAccumulator(nc, niou, ap_bins, device) if ap_bins else None  # bounded memory statistics
+    sampler, splits = dataloader.sampler, []  # stats index after each batch
+    stages = ('dataloader', 'h2d', 'forward', 'loss', 'nms', 'matching', 'metrics') if latency else ('forward', 'nms')
+    timer = StageTimer(stages)  # per batch latencies, without latency only inference and NMS for the speeds
+    clock = time_synchronized if latency else lambda: 0.0  # for stages timed outside timer()
+    rank, world_size = (sampler.rank, sampler.world_size) if isinstance(sampler, ShardSampler) else (-1, 1)
+    assert not (save_json and world_size > 1), 'save_json requires the whole val set on one process'
+
+    # Label txt and JSON files, written by a background thread one image at a time
+    writer, writes = ThreadPoolExecutor(1) if save_txt or save_json else None, deque()
+    if save_json:
+        w = Path(weights[0] if isinstance(weights, list) else weights).stem if weights is not None else ''  # weights
+        pred_json = str(save_dir / f"{w}_predictions.json")  # predictions json, only with predictions
+
+    def write(fn, *args):  # at most 64 images queued, completed writes dropped, raises any I/O error
+        writes.append(writer.submit(fn, *args))
+        while writes and (len(writes) > 64 or writes[0].done()):
+            writes.popleft().result()
+
+    # Raw model outputs cache, candidates above a confidence floor so that any conf_thres >= floor gives identical NMS,
+    # written one file per batch as they are recorded, complete once meta.pt exists
+    tta = augment and [(m.tta_scales, m.tta_pad) for m in model.modules() if isinstance(m, Model)]  # per model
+    ensemble = isinstance(model, Ensemble) and (model.fusion, model.weights, model.conf, model.iou)  # output fusion
+    cache_dir = eval_cache_dir(save_dir.parent / 'cache', weights, dataloader.dataset, imgsz, batch_size, single_cls, tta,
+                               half, ensemble) if (eval_cache or sweep) and not training else None  # next to save_dir
+    cache = torch.load(cache_dir / 'meta.pt') if cache_dir and (cache_dir / 'meta.pt').exists() else None
+    if cache and cache['floor'] > conf_thres:
+        cache = None  # recorded at a higher confidence floor
+    floor, record = min(conf_thres, 0.001), cache_dir is not None and not cache  # record outputs
+    if cache:
+        print(f'Using cached model outputs {cache_dir}')
+    elif record:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        if (cache_dir / 'meta.pt').exists():
+            (cache_dir / 'meta.pt').unlink()  # incomplete until all batches are written
+
+    t = clock()
+    batches = cached_batches(cache_dir, cache['batches']) if cache else dataloader
+    for batch_i, batch in enumerate(tqdm(batches, desc=s, total=len(dataloader), disable=rank > 0)):
+        timer.add('dataloader', clock() - t)  # waiting for the next batch
+        if cache:  # no images, outputs from cache
+            out, targets, paths, shapes, (nb, _, height, width) = batch
+            img, out, targets = None, out.to(device), targets.to(device).clone()
+        else:
+            with timer('h2d'):
+                img, targets, paths, shapes = batch
+                img = img.to(device, non_blocking=True)
+                img = img.half() if half else img.float()  # uint8 to fp16/32
+                img /= 255.0  # 0 - 255 to 0.0 - 1.0
+                targets = targets.to(device)
+            nb, _, height, width = img.shape  # batch size, channels, height, width
 
         with torch.no_grad():
-            # Run model
-            t = time_synchronized()
-            out, train_out = model(img, augment=augment)  # inference and training outputs
-            t0 += time_synchronized() - t
-
-            # Compute loss
-            if compute_loss:
-                loss += compute_loss([x.float() for x in train_out], targets)[1][:3]  # box, obj, cls
+            if img is not None:
+                # Run model
+                with timer('forward'):
+                    out, train_out = model(img, augment=augment)  # inference and training outputs
+                if record:
+                    candidates = pad_sequence([x[x[:, 4] > floor] for x in out], batch_first=True)
+                    torch.save((candidates.cpu(), targets.cpu().clone(), paths, shapes, tuple(img.shape)),
+                               cache_dir / f'batch{batch_i}.pt')
+
+                # Compute loss
+                if compute_loss:
+                    with timer('loss'):
+                        loss += compute_loss([x.float() for x in train_out], targets)[1][:3]  # box, obj, cls
 
             # Run NMS
             targets[:, 2:] *= torch.Tensor([width, height, width, height]).to(device)  # to pixels
             lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
-            t = time_synchronized()
-            out = non_max_suppression(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb, multi_label=True)
-            t1 += time_synchronized() - t
+            with timer('nms'):
+                out = non_max_suppression(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb, multi_label=True,
+                                          merge=merge)
 
         # Statistics per image
+        t = clock()
         for si, pred in enumerate(out):
             labels = targets[targets[:, 0] == si, 1:]
             nl = len(labels)
@@ -135,21 +297,19 @@ def test(data,
 
             if len(pred) == 0:
                 if nl:
-                    stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
+                    if accumulator:
+                        accumulator.update(torch.zeros(0, niou, dtype=torch.bool), torch.zeros(0), torch.zeros(0), tcls)
+                    else:
+                        stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
                 continue
 
             # Predictions
             predn = pred.clone()
-            scale_coords(img[si].shape[1:], predn[:, :4], shapes[si][0], shapes[si][1])  # native-space pred
+            scale_coords((height, width), predn[:, :4], shapes[si][0], shapes[si][1])  # native-space pred
 
             # Append to text file
             if save_txt:
-                gn = torch.tensor(shapes[si][0])[[1, 0, 1, 0]]  # normalization gain whwh
-                for *xyxy, conf, cls in predn.tolist():
-                    xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                    line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                    with open(save_dir / 'labels' / (path.stem + '.txt'), 'a') as f:
-                        f.write(('%g ' * len(line)).rstrip() % line + '\n')
+                write(save_one_txt, predn.cpu(), save_conf, shapes[si][0], save_dir / 'labels' / (path.stem + '.txt'))
 
             # W&B logging - Media Panel Plots
             if len(wandb_images) < log_imgs and wandb_logger.current_epoch > 0:  # Check for test operation
@@ -163,102 +323,120 @@ def test(data,
                     wandb_images.append(wandb_logger.wandb.Image(img[si], boxes=boxes, caption=path.name))
             wandb_logger.log_training_progress(predn, path, names) if wandb_logger and wandb_logger.wandb_run else None
 
-            # Append to pycocotools JSON dictionary
+            # Append to pycocotools JSON file
             if save_json:
-                # [{"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}, ...
                 image_id = int(path.stem) if path.stem.isnumeric() else path.stem
-                box = xyxy2xywh(predn[:, :4])  # xywh
-                box[:, :2] -= box[:, 2:] / 2  # xy center to top-left corner
-                for p, b in zip(pred.tolist(), box.tolist()):
-                    jdict.append({'image_id': image_id,
-                                  'category_id': coco91class[int(p[5])] if is_coco else int(p[5]),
-                                  'bbox': [round(x, 3) for x in b],
-                                  'score': round(p[4], 5)})
+                write(save_one_json, pred.cpu(), predn.cpu(), image_id, class_map, pred_json, nj == 0)
+                nj += len(pred)
 
             # Assign all predictions as incorrect
             correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=device)
             if nl:
-                detected = []  # target indices
-                tcls_tensor = labels[:, 0]
-
                 # target boxes
                 tbox = xywh2xyxy(labels[:, 1:5])
-                scale_coords(img[si].shape[1:], tbox, shapes[si][0], shapes[si][1])  # native-space labels
+                scale_coords((height, width), tbox, shapes[si][0], shapes[si][1])
+                labelsn = torch.cat((labels[:, 0:1], tbox), 1)  # native-space labels
                 if plots:
-                    confusion_matrix.process_batch(predn, torch.cat((labels[:, 0:1], tbox), 1))
-
-                # Per target class
-                for cls in torch.unique(tcls_tensor):
-                    ti = (cls == tcls_tensor).nonzero(as_tuple=False).view(-1)  # prediction indices
-                    pi = (cls == pred[:, 5]).nonzero(as_tuple=False).view(-1)  # target indices
-
-                    # Search for detections
-                    if pi.shape[0]:
-                        # Prediction to target ious
-                        ious, i = box_iou(predn[pi, :4], tbox[ti]).max(1)  # best ious, indices
-
-                        # Append detections
-                        detected_set = set()
-                        for j in (ious > iouv[0]).nonzero(as_tuple=False):
-                            d = ti[i[j]]  # detected target
-                            if d.item() not in detected_set:
-                                detected_set.add(d.item())
-                                detected.append(d)
-                                correct[pi[j]] = ious[j] > iouv  # iou_thres is 1xn
-                                if len(detected) == nl:  # all targets already located in image
-                                    break
+                    confusion_matrix.process_batch(predn, labelsn)
+                correct = match_predictions(predn, labelsn, iouv)
 
             # Append statistics (correct, conf, pcls, tcls)
-            stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
+            if accumulator:
+                accumulator.update(correct, pred[:, 4], pred[:, 5], tcls)
+            else:
+                stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
+        timer.add('matching', clock() - t)
 
         # Plot images
-        if plots and batch_i < 3:
+        if plots and batch_i < 3 and img is not None:
+            im = (img[:16] * 255).byte().cpu().numpy()  # the plotted images only, uint8 to pickle less
             f = save_dir / f'test_batch{batch_i}_labels.jpg'  # labels
-            Thread(target=plot_images, args=(img, targets, paths, f, names), daemon=True).start()
+            plot_pool.submit(plot_images, im, targets.cpu().numpy(), paths, f, names)
             f = save_dir / f'test_batch{batch_i}_pred.jpg'  # predictions
-            Thread(target=plot_images, args=(img, output_to_target(out), paths, f, names), daemon=True).start()
+            plot_pool.submit(plot_images, im, output_to_target(out), paths, f, names)
+        splits.append(len(stats))
+        t = clock()
+
+    if record:
+        torch.save({'floor': floor, 'batches': batch_i + 1}, cache_dir / 'meta.pt')
+
+    t0, t1 = timer.total('forward'), timer.total('nms')
+
+    # Gather results of all DDP processes in dataset order, each validated batches rank, rank + world_size, ...
+    nb = len(dataloader)
+    if world_size > 1:
+        parts = [None] * world_size
+        dist.all_gather_object(parts, ([stats[i:j] for i, j in zip([0] + splits, splits)], seen, t0, t1,
+                                       loss.cpu(), nb, confusion_matrix.matrix))
+        batches = [part[0] for part in parts]  # per rank, per batch stats
+        stats = [x for k in range(max(len(b) for b in batches)) for b in batches if k < len(b) for x in b[k]]
+        seen, loss, nb, confusion_matrix.matrix = (sum(x[i] for x in parts) for i in (1, 4, 5, 6))
+        t0, t1 = (sum(x[i] for x in parts) / world_size for i in (2, 3))  # mean time, processes run concurrently
+        if accumulator:
+            accumulator.all_reduce()
 
     # Compute statistics
+    t = clock()
     stats = [np.concatenate(x, 0) for x in zip(*stats)]  # to numpy
-    if len(stats) and stats[0].any():
+    if accumulator and accumulator.tp.any():  # streamed confidence histograms
+        p, r, ap, f1, ap_class = accumulator.compute(v5_metric=v5_metric, plot=plots, save_dir=save_dir, names=names)
+        nt = accumulator.nl.cpu().numpy()  # number of targets per class
+    elif len(stats) and stats[0].any():
         p, r, ap, f1, ap_class = ap_per_class(*stats, plot=plots, v5_metric=v5_metric, save_dir=save_dir, names=names)
-        ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
-        mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
         nt = np.bincount(stats[3].astype(np.int64), minlength=nc)  # number of targets per class
     else:
         nt = torch.zeros(1)
+    if len(ap_class):
+        ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
+        mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
+    timer.add('metrics', clock() - t)
 
     # Print results
     pf = '%20s' + '%12i' * 2 + '%12.3g' * 4  # print format
-    print(pf % ('all', seen, nt.sum(), mp, mr, map50, map))
+    if rank in [-1, 0]:
+        print(pf % ('all', seen, nt.sum(), mp, mr, map50, map))
 
     # Print results per class
-    if (verbose or (nc < 50 and not training)) and nc > 1 and len(stats):
+    if (verbose or (nc < 50 and not training)) and nc > 1 and len(ap_class) and rank in [-1, 0]:
         for i, c in enumerate(ap_class):
             print(pf % (names[c], seen, nt[c], p[i], r[i], ap50[i], ap[i]))
 
     # Print speeds
-    t = tuple(x / seen * 1E3 for x in (t0, t1, t0 + t1)) + (imgsz, imgsz, batch_size)  # tuple
+    t = tuple(x / (seen / world_size) * 1E3 for x in (t0, t1, t0 + t1)) + (imgsz, imgsz, batch_size)  # per process
     if not training:
         print('Speed: %.1f/%.1f/%.1f ms inference/NMS/total per %gx%g image at batch-size %g' % t)
+    if latency:  # per batch stage latencies of this process
+        timer.print()
+        if rank in [-1, 0]:
+            timer.save(save_dir / 'latency.json')
+
+    # Threshold sweep over the recorded model outputs
+    if sweep and cache_dir:
+        sweep_thresholds(cached_batches(cache_dir, len(dataloader)), *sweep, iouv, nc, save_dir, v5_metric, merge)
 
     # Plots
     if plots:
-        confusion_matrix.plot(save_dir=save_dir, names=list(names.values()))
+        plot_pool.submit(confusion_matrix.plot, save_dir=save_dir, names=list(names.values()))
         if wandb_logger and wandb_logger.wandb:
+            plot_pool.join()  # logged right away
             val_batches = [wandb_logger.wandb.Image(str(f), caption=f.name) for f in sorted(save_dir.glob('test*.jpg'))]
             wandb_logger.log({"Validation": val_batches})
     if wandb_images:
         wandb_logger.log({"Bounding Box Debugger/Images": wandb_images})
 
+    # Finish writing label txt and JSON files
+    if writer:
+        writer.shutdown()
+        for x in writes:
+            x.result()  # raise any I/O error
+    if save_json and nj:
+        with open(pred_json, 'a') as f:
+            f.write(']')
+
     # Save JSON
-    if save_json and len(jdict):
-        w = Path(weights[0] if isinstance(weights, list) else weights).stem if weights is not None else ''  # weights
+    if save_json and nj:
         anno_json = './coco/annotations/instances_val2017.json'  # annotations json
-        pred_json = str(save_dir / f"{w}_predictions.json")  # predictions json
-        print('\nEvaluating pycocotools mAP... saving %s...' % pred_json)
-        with open(pred_json, 'w') as f:
-            json.dump(jdict, f)
+        print('\nEvaluating pycocotools mAP... saved %s...' % pred_json)
 
         try:  # https://github.com/cocodataset/cocoapi/blob/master/PythonAPI/pycocoEvalDemo.ipynb
             from pycocotools.coco import COCO
@@ -279,12 +457,13 @@ def test(data,
     # Return results
     model.float()  # for training
     if not training:
+        plot_pool.join()  # figures written, failures reported
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         print(f"Results saved to {save_dir}{s}")
     maps = np.zeros(nc) + map
     for i, c in enumerate(ap_class):
         maps[c] = ap[i]
-    return (mp, mr, map50, map, *(loss.cpu() / len(dataloader)).tolist()), maps, t
+    return (mp, mr, map50, map, *(loss.cpu() / nb).tolist()), maps, t
 
 
 if __name__ == '__main__':
@@ -295,10 +474,12 @@ if __name__ == '__main__':
     parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
     parser.add_argument('--conf-thres', type=float, default=0.001, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.65, help='IOU threshold for NMS')
-    parser.add_argument('--task', default='val', help='train, val, test, speed or study')
+    parser.add_argument('--task', default='val', help='train, val, test, speed, study or sweep')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--single-cls', action='store_true', help='treat as single-class dataset')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
+    parser.add_argument('--tta-scales', nargs='+', type=float, help='augmented inference scales, implies --augment')
+    parser.add_argument('--merge', action='store_true', help='merge-NMS (weighted box fusion), e.g. with --augment')
     parser.add_argument('--verbose', action='store_true', help='report mAP by class')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--save-hybrid', action='store_true', help='save label+prediction hybrid results to *.txt')
@@ -309,9 +490,19 @@ if __name__ == '__main__':
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--no-trace', action='store_true', help='don`t trace model')
     parser.add_argument('--v5-metric', action='store_true', help='assume maximum recall as 1.0 in AP calculation')
+    parser.add_argument('--eval-cache', action='store_true', help='cache raw model outputs, reuse them for NMS/metrics')
+    parser.add_argument('--sweep-conf', nargs='+', type=float, default=[0.001, 0.01, 0.05, 0.1, 0.25, 0.5], help='--task sweep conf_thres values')
+    parser.add_argument('--sweep-iou', nargs='+', type=float, default=[0.45, 0.5, 0.6, 0.65, 0.7], help='--task sweep iou_thres values')
+    parser.add_argument('--ap-bins', type=int, default=0, help='bounded-memory mAP with this many confidence bins, 0 exact')
+    parser.add_argument('--ensemble-parallel', action='store_true', help='run ensemble models concurrently')
+    parser.add_argument('--latency', action='store_true', help='per batch stage latencies, saved as latency.json')
+    parser.add_argument('--ensemble-wbf', nargs='*', type=float, help='weighted box fusion of ensemble models, optional model weights')
     opt = parser.parse_args()
     opt.save_json |= opt.data.endswith('coco.yaml')
     opt.data = check_file(opt.data)  # check file
+    opt.augment |= bool(opt.tta_scales)
+    ensemble = dict(ensemble_parallel=opt.ensemble_parallel, ensemble_fusion='nms' if opt.ensemble_wbf is None else 'wbf',
+                    ensemble_weights=opt.ensemble_wbf or None)  # for several --weights
     print(opt)
     #check_requirements()
 
@@ -330,13 +521,25 @@ if __name__ == '__main__':
              save_hybrid=opt.save_hybrid,
              save_conf=opt.save_conf,
              trace=not opt.no_trace,
-             v5_metric=opt.v5_metric
+             v5_metric=opt.v5_metric,
+             ap_bins=opt.ap_bins,
+             eval_cache=opt.eval_cache,
+             latency=opt.latency,
+             merge=opt.merge,
+             tta_scales=opt.tta_scales,
+             **ensemble
              )
 
     elif opt.task == 'speed':  # speed benchmarks
         for w in opt.weights:
             test(opt.data, w, opt.batch_size, opt.img_size, 0.25, 0.45, save_json=False, plots=False, v5_metric=opt.v5_metric)
 
+    elif opt.task == 'sweep':  # conf/IoU threshold grid from a single inference pass
+        # python test.py --task sweep --data coco.yaml --weights yolov7.pt --sweep-conf 0.05 0.1 0.25 --sweep-iou 0.45 0.65
+        test(opt.data, opt.weights, opt.batch_size, opt.img_size, min(opt.sweep_conf), opt.iou_thres, single_cls=opt.single_cls,
+             augment=opt.augment, plots=False, trace=not opt.no_trace, v5_metric=opt.v5_metric,
+             sweep=(opt.sweep_conf, opt.sweep_iou), merge=opt.merge, tta_scales=opt.tta_scales, **ensemble)
+
     elif opt.task == 'study':  # run over a range of settings and save/plot
         # python test.py --task study --data coco.yaml --iou 0.65 --weights yolov7.pt
         x = list(range(256, 1536 + 128, 128))  # x axis (image sizes)
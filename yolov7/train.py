@@ -1,4 +1,5 @@
 import argparse
+import itertools
 import logging
 import math
 import os
@@ -25,14 +26,15 @@ import test  # import test.py to get mAP after each epoch
 from models.experimental import attempt_load
 from models.yolo import Model
 from utils.autoanchor import check_anchors
-from utils.datasets import create_dataloader
+from utils.datasets import create_dataloader, DeviceAugment
 from utils.general import labels_to_class_weights, increment_path, labels_to_image_weights, init_seeds, \
     fitness, strip_optimizer, get_latest_run, check_dataset, check_file, check_git_status, check_img_size, \
     check_requirements, print_mutation, set_logging, one_cycle, colorstr
 from utils.google_utils import attempt_download
 from utils.loss import ComputeLoss, ComputeLossOTA
-from utils.plots import plot_images, plot_labels, plot_results, plot_evolution
-from utils.torch_utils import ModelEMA, select_device, intersect_dicts, torch_distributed_zero_first, is_parallel
+from utils.plots import plot_images, plot_labels, plot_results, plot_evolution, plot_pool
+from utils.torch_utils import ModelEMA, copy_attr, select_device, intersect_dicts, torch_distributed_zero_first, \
+    is_parallel
 from utils.wandb_logging.wandb_utils import WandbLogger, check_wandb_resume
 
 logger = logging.getLogger(__name__)
@@ -198,6 +200,7 @@ def train(hyp, opt, device, tb_writer=None):
 
     # EMA
     ema = ModelEMA(model) if rank in [-1, 0] else None
+    val_model = ema.ema if ema else deepcopy(model).eval().requires_grad_(False) if opt.dist_val else None  # rank 0 EMA
 
     # Resume
     start_epoch, best_fitness = 0, 0.0
@@ -242,21 +245,26 @@ def train(hyp, opt, device, tb_writer=None):
         logger.info('Using SyncBatchNorm()')
 
     # Trainloader
+    assert not (opt.fused_augment and opt.device_augment), '--fused-augment and --device-augment are exclusive'
     dataloader, dataset = create_dataloader(train_path, imgsz, batch_size, gs, opt,
                                             hyp=hyp, augment=True, cache=opt.cache_images, rect=opt.rect, rank=rank,
                                             world_size=opt.world_size, workers=opt.workers,
-                                            image_weights=opt.image_weights, quad=opt.quad, prefix=colorstr('train: '))
+                                            image_weights=opt.image_weights, quad=opt.quad, prefix=colorstr('train: '),
+                                            fused_augment=opt.fused_augment, device_augment=opt.device_augment)
+    device_augment = DeviceAugment(hyp) if opt.device_augment else None  # on-device HSV, flips, affine
     mlc = np.concatenate(dataset.labels, 0)[:, 0].max()  # max label class
     nb = len(dataloader)  # number of batches
     assert mlc < nc, 'Label class %g exceeds nc=%g in %s. Possible class labels are 0-%g' % (mlc, nc, opt.data, nc - 1)
 
-    # Process 0
-    if rank in [-1, 0]:
+    # Testloader, sharded over DDP processes with --dist-val
+    if rank in [-1, 0] or opt.dist_val:
         testloader = create_dataloader(test_path, imgsz_test, batch_size * 2, gs, opt,  # testloader
-                                       hyp=hyp, cache=opt.cache_images and not opt.notest, rect=True, rank=-1,
-                                       world_size=opt.world_size, workers=opt.workers,
-                                       pad=0.5, prefix=colorstr('val: '))[0]
+                                       hyp=hyp, cache=opt.cache_images and not opt.notest, rect=True,
+                                       rank=rank if opt.dist_val else -1, world_size=opt.world_size,
+                                       workers=opt.workers, pad=0.5, prefix=colorstr('val: '), shard=opt.dist_val)[0]
 
+    # Process 0
+    if rank in [-1, 0]:
         if not opt.resume:
             labels = np.concatenate(dataset.labels, 0)
             c = torch.tensor(labels[:, 0])  # classes
@@ -333,9 +341,11 @@ def train(hyp, opt, device, tb_writer=None):
         if rank in [-1, 0]:
             pbar = tqdm(pbar, total=nb)  # progress bar
         optimizer.zero_grad()
-        for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
+        for i, (imgs, targets, paths, shapes) in pbar:  # batch --------------------------------------------------------
             ni = i + nb * epoch  # number integrated batches (since train start)
             imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
+            if device_augment:  # mosaics (shapes None) were already warped on CPU
+                imgs, targets = device_augment(imgs, targets.to(device), warp=[x is not None for x in shapes])
 
             # Warmup
             if ni <= nw:
@@ -405,27 +415,33 @@ def train(hyp, opt, device, tb_writer=None):
         lr = [x['lr'] for x in optimizer.param_groups]  # for tensorboard
         scheduler.step()
 
-        # DDP process 0 or single-GPU
-        if rank in [-1, 0]:
-            # mAP
-            ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'gr', 'names', 'stride', 'class_weights'])
-            final_epoch = epoch + 1 == epochs
+        # mAP, on all DDP processes with --dist-val
+        final_epoch = epoch + 1 == epochs
+        if rank in [-1, 0] or opt.dist_val:
+            copy_attr(val_model, model, include=['yaml', 'nc', 'hyp', 'gr', 'names', 'stride', 'class_weights'],
+                      exclude=('process_group', 'reducer'))  # ema.update_attr() on rank 0
             if not opt.notest or final_epoch:  # Calculate mAP
-                wandb_logger.current_epoch = epoch + 1
+                if rank in [-1, 0]:
+                    wandb_logger.current_epoch = epoch + 1
+                if opt.dist_val:  # every process validates rank 0's EMA, BN statistics differ without --sync-bn
+                    for x in itertools.chain(val_model.parameters(), val_model.buffers()):
+                        dist.broadcast(x, 0)
                 results, maps, times = test.test(data_dict,
                                                  batch_size=batch_size * 2,
                                                  imgsz=imgsz_test,
-                                                 model=ema.ema,
+                                                 model=val_model,
                                                  single_cls=opt.single_cls,
                                                  dataloader=testloader,
                                                  save_dir=save_dir,
                                                  verbose=nc < 50 and final_epoch,
-                                                 plots=plots and final_epoch,
-                                                 wandb_logger=wandb_logger,
+                                                 plots=plots and final_epoch and rank in [-1, 0],
+                                                 wandb_logger=wandb_logger if rank in [-1, 0] else None,
                                                  compute_loss=compute_loss,
                                                  is_coco=is_coco,
                                                  v5_metric=opt.v5_metric)
 
+        # DDP process 0 or single-GPU
+        if rank in [-1, 0]:
             # Write
             with open(results_file, 'a') as f:
                 f.write(s + '%10.4g' * 7 % results + '\n')  # append metrics, val_loss
@@ -485,12 +501,16 @@ def train(hyp, opt, device, tb_writer=None):
         if plots:
             plot_results(save_dir=save_dir)  # save as results.png
             if wandb_logger.wandb:
+                plot_pool.join()  # validation plots of the final epoch
                 files = ['results.png', 'confusion_matrix.png', *[f'{x}_curve.png' for x in ('F1', 'PR', 'P', 'R')]]
                 wandb_logger.log({"Results": [wandb_logger.wandb.Image(str(save_dir / f), caption=f) for f in files
                                               if (save_dir / f).exists()]})
         # Test best.pt
         logger.info('%g epochs completed in %.3f hours.\n' % (epoch - start_epoch + 1, (time.time() - t0) / 3600))
         if opt.data.endswith('coco.yaml') and nc == 80:  # if COCO
+            if opt.dist_val:  # process 0 alone, whole val set
+                testloader = create_dataloader(test_path, imgsz_test, batch_size * 2, gs, opt, hyp=hyp, rect=True,
+                                               workers=opt.workers, pad=0.5, prefix=colorstr('val: '))[0]
             for m in (last, best) if best.exists() else (last):  # speed, mAP tests
                 results, _, _ = test.test(opt.data,
                                           batch_size=batch_size * 2,
@@ -554,6 +574,8 @@ if __name__ == '__main__':
     parser.add_argument('--name', default='exp', help='save to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--quad', action='store_true', help='quad dataloader')
+    parser.add_argument('--fused-augment', action='store_true', help='apply perspective and flips in a single warp')
+    parser.add_argument('--device-augment', action='store_true', help='apply HSV, flips and affine on the training device')
     parser.add_argument('--linear-lr', action='store_true', help='linear LR')
     parser.add_argument('--label-smoothing', type=float, default=0.0, help='Label smoothing epsilon')
     parser.add_argument('--upload_dataset', action='store_true', help='Upload dataset as W&B artifact table')
@@ -562,6 +584,7 @@ if __name__ == '__main__':
     parser.add_argument('--artifact_alias', type=str, default="latest", help='version of dataset artifact to be used')
     parser.add_argument('--freeze', nargs='+', type=int, default=[0], help='Freeze layers: backbone of yolov7=50, first3=0 1 2')
     parser.add_argument('--v5-metric', action='store_true', help='assume maximum recall as 1.0 in AP calculation')
+    parser.add_argument('--dist-val', action='store_true', help='validate on all DDP processes, each a shard of the val set')
     opt = parser.parse_args()
 
     # Set DDP variables
@@ -592,6 +615,7 @@ if __name__ == '__main__':
 
     # DDP mode
     opt.total_batch_size = opt.batch_size
+    opt.dist_val &= opt.local_rank != -1  # sharded validation needs DDP
     device = select_device(opt.device, batch_size=opt.batch_size)
     if opt.local_rank != -1:
         assert torch.cuda.device_count() > opt.local_rank
@@ -7,6 +7,8 @@ import os
 import random
 import shutil
 import time
+from contextlib import contextmanager, nullcontext
+from functools import partial, wraps
 from itertools import repeat
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
@@ -26,8 +28,8 @@ from copy import deepcopy
 from torchvision.utils import save_image
 from torchvision.ops import roi_pool, roi_align, ps_roi_pool, ps_roi_align
 
-from utils.general import check_requirements, xyxy2xywh, xywh2xyxy, xywhn2xyxy, xyn2xy, segment2box, segments2boxes, \
-    resample_segments, clean_str
+from utils.general import check_requirements, xyxy2xywh, xywh2xyxy, xywhn2xyxy, xyn2xy, segment2box, segments2box, \
+    segments2boxes, resample_segments, resample_segments_packed, pack_segments, unpack_segments, clean_str
 from utils.torch_utils import torch_distributed_zero_first
 
 # Parameters
@@ -63,7 +65,8 @@ def exif_size(img):
 
 
 def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=False, cache=False, pad=0.0, rect=False,
-                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix=''):
+                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix='', fused_augment=False,
+                      device_augment=False, profiler=None, shard=False):
     # Make sure only the first process in DDP process the dataset first, and the following others can use the cache
     with torch_distributed_zero_first(rank):
         dataset = LoadImagesAndLabels(path, imgsz, batch_size,
@@ -75,22 +78,80 @@ def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=Fa
                                       stride=int(stride),
                                       pad=pad,
                                       image_weights=image_weights,
-                                      prefix=prefix)
+                                      prefix=prefix,
+                                      fused_augment=fused_augment,
+                                      device_augment=device_augment,
+                                      profiler=profiler)
 
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, workers])  # number of workers
-    sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
-    loader = torch.utils.data.DataLoader if image_weights else InfiniteDataLoader
+    if profiler:
+        profiler.resize(nw)  # effective workers
+    if shard:  # whole rectangular batches per DDP process, i.e. distributed validation
+        sampler = ShardSampler(dataset, batch_size, rank, world_size)
+    else:
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
+    # InfiniteDataLoader would spin forever on an empty shard
+    loader = torch.utils.data.DataLoader if image_weights or (shard and not len(sampler)) else InfiniteDataLoader
+    collate_fn = LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn
     # Use torch.utils.data.DataLoader() if dataset.properties will update during training else InfiniteDataLoader()
     dataloader = loader(dataset,
                         batch_size=batch_size,
                         num_workers=nw,
                         sampler=sampler,
                         pin_memory=True,
-                        collate_fn=LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn)
+                        collate_fn=partial(profiler.collate, collate_fn) if profiler else collate_fn)
     return dataloader, dataset
 
 
+class DataloaderProfiler:
+    """ Exclusive wall time per dataset loading stage, summed per dataloader worker in shared memory
+
+    Usage: profiler = DataloaderProfiler(); create_dataloader(..., profiler=profiler); profiler.times
+    """
+    stages = 'decode', 'mosaic', 'perspective', 'hsv', 'paste_in', 'other', 'collate'
+
+    def __init__(self, workers=0):
+        self.resize(workers)
+        self.stack = []  # time spent in nested stages, per open stage
+
+    def resize(self, workers):
+        # One row per dataloader worker (one for the main process without), before the workers start
+        self.times = torch.zeros(max(workers, 1), len(self.stages), dtype=torch.float64).share_memory_()  # (worker, stage)
+
+    @contextmanager
+    def __call__(self, stage):
+        self.stack.append(0.0)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t
+            child = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += dt  # exclude from enclosing stage
+            worker = torch.utils.data.get_worker_info()
+            self.times[worker.id if worker else 0, self.stages.index(stage)] += dt - child
+
+    def collate(self, collate_fn, batch):
+        with self('collate'):
+            return collate_fn(batch)
+
+    def reset(self):
+        self.times.zero_()
+
+
+def profiled(stage):
+    # Decorator timing f(self, ...) as a loading stage of self.profiler, if any
+    def decorator(f):
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            with self.profile(stage):
+                return f(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class InfiniteDataLoader(torch.utils.data.dataloader.DataLoader):
     """ Dataloader that reuses workers
 
@@ -125,6 +186,26 @@ class _RepeatSampler(object):
             yield from iter(self.sampler)
 
 
+class ShardSampler(torch.utils.data.Sampler):
+    """ Sampler that splits a dataset into whole batches per DDP process, without padding or shuffling
+
+    Process rank gets batches rank, rank + world_size, ... so every image is seen exactly once and, with rect=True,
+    every batch keeps its shape
+    """
+
+    def __init__(self, dataset, batch_size, rank, world_size):
+        self.rank, self.world_size = rank, world_size
+        n = len(dataset)
+        self.indices = [i for b in range(rank, math.ceil(n / batch_size), world_size)
+                        for i in range(b * batch_size, min((b + 1) * batch_size, n))]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+
 class LoadImages:  # for inference
     def __init__(self, path, img_size=640, stride=32):
         p = str(Path(path).absolute())  # os-agnostic absolute path
@@ -352,9 +433,13 @@ def img2label_paths(img_paths):
 
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix=''):
+                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix='', fused_augment=False,
+                 device_augment=False, profiler=None):
         self.img_size = img_size
         self.augment = augment
+        self.fused_augment = fused_augment  # single-warp perspective + flips, see fused_perspective()
+        self.device_augment = device_augment  # HSV, flips and non-mosaic perspective left to DeviceAugment
+        self.profiler = None  # DataloaderProfiler, attached after image caching
         self.hyp = hyp
         self.image_weights = image_weights
         self.rect = False if image_weights else rect
@@ -362,6 +447,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         self.mosaic_border = [-img_size // 2, -img_size // 2]
         self.stride = stride
         self.path = path        
+        self.mosaic_buffers = {}  # reusable mosaic canvases, one set per dataloader worker process
         #self.albumentations = Albumentations() if augment else None
 
         try:
@@ -466,6 +552,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                     gb += self.imgs[i].nbytes
                 pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB)'
             pbar.close()
+        self.profiler = profiler
 
     def cache_labels(self, path=Path('./labels.cache'), prefix=''):
         # Cache dataset labels, check images and read shapes
@@ -525,17 +612,23 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
     def __len__(self):
         return len(self.img_files)
 
+    def profile(self, stage):
+        # Context manager timing a loading stage when a DataloaderProfiler is attached
+        return self.profiler(stage) if self.profiler else nullcontext()
+
     # def __iter__(self):
     #     self.count = -1
     #     print('ran dataset iter')
     #     #self.shuffled_vector = np.random.permutation(self.nF) if self.augment else np.arange(self.nF)
     #     return self
 
+    @profiled('other')
     def __getitem__(self, index):
         index = self.indices[index]  # linear, shuffled, or image_weights
 
         hyp = self.hyp
         mosaic = self.mosaic and random.random() < hyp['mosaic']
+        fused = self.augment and self.fused_augment  # flips applied inside the perspective warp
         if mosaic:
             # Load mosaic
             if random.random() < 0.8:
@@ -560,7 +653,10 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
             # Letterbox
             shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
-            img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
+            if fused:  # deferred to the perspective warp
+                L, shape, ratio, pad = letterbox_matrix(img.shape[:2], shape, scaleup=self.augment)
+            else:
+                img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
             shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
 
             labels = self.labels[index].copy()
@@ -569,35 +665,42 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
         if self.augment:
             # Augment imagespace
-            if not mosaic:
-                img, labels = random_perspective(img, labels,
-                                                 degrees=hyp['degrees'],
-                                                 translate=hyp['translate'],
-                                                 scale=hyp['scale'],
-                                                 shear=hyp['shear'],
-                                                 perspective=hyp['perspective'])
+            if not mosaic and fused:
+                with self.profile('perspective'):
+                    img, labels = fused_perspective(img, labels, hyp=hyp, pre=L, shape=shape)
+            elif not mosaic and not self.device_augment:
+                with self.profile('perspective'):
+                    img, labels = random_perspective(img, labels,
+                                                     degrees=hyp['degrees'],
+                                                     translate=hyp['translate'],
+                                                     scale=hyp['scale'],
+                                                     shear=hyp['shear'],
+                                                     perspective=hyp['perspective'])
             
             
             #img, labels = self.albumentations(img, labels)
 
             # Augment colorspace
-            augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
+            if not self.device_augment:
+                with self.profile('hsv'):
+                    augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
 
             # Apply cutouts
             # if random.random() < 0.9:
             #     labels = cutout(img, labels)
             
             if random.random() < hyp['paste_in']:
-                sample_labels, sample_images, sample_masks = [], [], [] 
-                while len(sample_labels) < 30:
-                    sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
-                    sample_labels += sample_labels_
-                    sample_images += sample_images_
-                    sample_masks += sample_masks_
-                    #print(len(sample_labels))
-                    if len(sample_labels) == 0:
-                        break
-                labels = pastein(img, labels, sample_labels, sample_images, sample_masks)
+                with self.profile('paste_in'):  # sampling and pasting, image decodes excluded
+                    sample_labels, sample_images, sample_masks = [], [], [] 
+                    while len(sample_labels) < 30:
+                        sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
+                        sample_labels += sample_labels_
+                        sample_images += sample_images_
+                        sample_masks += sample_masks_
+                        #print(len(sample_labels))
+                        if len(sample_labels) == 0:
+                            break
+                    labels = pastein(img, labels, sample_labels, sample_images, sample_masks)
 
         nL = len(labels)  # number of labels
         if nL:
@@ -605,7 +708,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             labels[:, [2, 4]] /= img.shape[0]  # normalized height 0-1
             labels[:, [1, 3]] /= img.shape[1]  # normalized width 0-1
 
-        if self.augment:
+        if self.augment and not fused and not self.device_augment:
             # flip up-down
             if random.random() < hyp['flipud']:
                 img = np.flipud(img)
@@ -663,6 +766,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
 
 # Ancillary functions --------------------------------------------------------------------------------------------------
+@profiled('decode')
 def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
     img = self.imgs[index]
@@ -682,7 +786,7 @@ def load_image(self, index):
 
 def augment_hsv(img, hgain=0.5, sgain=0.5, vgain=0.5):
     r = np.random.uniform(-1, 1, 3) * [hgain, sgain, vgain] + 1  # random gains
-    hue, sat, val = cv2.split(cv2.cvtColor(img, cv2.COLOR_BGR2HSV))
+    img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
     dtype = img.dtype  # uint8
 
     x = np.arange(0, 256, dtype=np.int16)
@@ -690,7 +794,8 @@ def augment_hsv(img, hgain=0.5, sgain=0.5, vgain=0.5):
     lut_sat = np.clip(x * r[1], 0, 255).astype(dtype)
     lut_val = np.clip(x * r[2], 0, 255).astype(dtype)
 
-    img_hsv = cv2.merge((cv2.LUT(hue, lut_hue), cv2.LUT(sat, lut_sat), cv2.LUT(val, lut_val))).astype(dtype)
+    lut = np.stack((lut_hue, lut_sat, lut_val), 1).reshape(256, 1, 3)  # 3-channel LUT, one pass instead of split/merge
+    cv2.LUT(img_hsv, lut, dst=img_hsv)
     cv2.cvtColor(img_hsv, cv2.COLOR_HSV2BGR, dst=img)  # no return needed
 
 
@@ -705,10 +810,45 @@ def hist_equalize(img, clahe=True, bgr=False):
     return cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR if bgr else cv2.COLOR_YUV2RGB)  # convert YUV image to RGB
 
 
+def mosaic_canvas(self, shape):
+    # Returns a reusable mosaic canvas of shape (h,w,c) filled with 114. Each dataloader worker holds its own dataset
+    # copy, so buffers are per-worker and the 2s x 2s (3s x 3s) allocation is not repeated for every sample
+    buf = self.mosaic_buffers.get(shape)
+    if buf is None:
+        buf = self.mosaic_buffers[shape] = np.empty(shape, dtype=np.uint8)
+    buf.fill(114)
+    return buf
+
+
+def mosaic_release(self, img):
+    # Copy img if it still shares memory with a mosaic canvas (i.e. random_perspective() did not warp it)
+    return img.copy() if any(np.may_share_memory(img, x) for x in self.mosaic_buffers.values()) else img
+
+
+def mosaic_labels(self, indices, tiles):
+    # Normalized xywh to clipped pixel xyxy labels and segments for all mosaic tiles at once, tiles = [(w, h, padw, padh)]
+    s = self.img_size
+    tiles = np.array(tiles, dtype=np.float32)
+    labels = [self.labels[i] for i in indices]
+    g = np.repeat(tiles, [len(x) for x in labels], 0)  # per-label gains
+    labels = np.concatenate(labels, 0)
+    labels[:, 1:] = xywhn2xyxy(labels[:, 1:], g[:, 0], g[:, 1], g[:, 2], g[:, 3])
+    np.clip(labels[:, 1:], 0, 2 * s, out=labels[:, 1:])
+
+    segments = [self.segments[i] for i in indices]
+    xy, offsets = pack_segments([x for tile in segments for x in tile])
+    if len(xy):
+        g = np.repeat(tiles, [sum(len(x) for x in tile) for tile in segments], 0)  # per-point gains
+        xy = xyn2xy(xy, g[:, 0], g[:, 1], g[:, 2], g[:, 3])
+        np.clip(xy, 0, 2 * s, out=xy)
+    return labels, unpack_segments(xy, offsets)
+
+
+@profiled('mosaic')
 def load_mosaic(self, index):
     # loads images in a 4-mosaic
 
-    labels4, segments4 = [], []
+    tiles = []  # (w, h, padw, padh) per tile
     s = self.img_size
     yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
     indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
@@ -718,7 +858,7 @@ def load_mosaic(self, index):
 
         # place img in img4
         if i == 0:  # top left
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
+            img4 = mosaic_canvas(self, (s * 2, s * 2, img.shape[2]))  # base image with 4 tiles
             x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
             x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
         elif i == 1:  # top right
@@ -732,42 +872,36 @@ def load_mosaic(self, index):
             x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
         img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
-        padw = x1a - x1b
-        padh = y1a - y1b
-
-        # Labels
-        labels, segments = self.labels[index].copy(), self.segments[index].copy()
-        if labels.size:
-            labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
-            segments = [xyn2xy(x, w, h, padw, padh) for x in segments]
-        labels4.append(labels)
-        segments4.extend(segments)
-
-    # Concat/clip labels
-    labels4 = np.concatenate(labels4, 0)
-    for x in (labels4[:, 1:], *segments4):
-        np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
+        tiles.append((w, h, x1a - x1b, y1a - y1b))  # w, h, padw, padh
+
+    # Labels
+    labels4, segments4 = mosaic_labels(self, indices, tiles)  # clip when using random_perspective()
     # img4, labels4 = replicate(img4, labels4)  # replicate
 
     # Augment
     #img4, labels4, segments4 = remove_background(img4, labels4, segments4)
     #sample_segments(img4, labels4, segments4, probability=self.hyp['copy_paste'])
     img4, labels4, segments4 = copy_paste(img4, labels4, segments4, probability=self.hyp['copy_paste'])
-    img4, labels4 = random_perspective(img4, labels4, segments4,
-                                       degrees=self.hyp['degrees'],
-                                       translate=self.hyp['translate'],
-                                       scale=self.hyp['scale'],
-                                       shear=self.hyp['shear'],
-                                       perspective=self.hyp['perspective'],
-                                       border=self.mosaic_border)  # border to remove
+    with self.profile('perspective'):
+        if self.fused_augment:
+            img4, labels4 = fused_perspective(img4, labels4, segments4, self.hyp, border=self.mosaic_border)
+        else:
+            img4, labels4 = random_perspective(img4, labels4, segments4,
+                                               degrees=self.hyp['degrees'],
+                                               translate=self.hyp['translate'],
+                                               scale=self.hyp['scale'],
+                                               shear=self.hyp['shear'],
+                                               perspective=self.hyp['perspective'],
+                                               border=self.mosaic_border)  # border to remove
 
-    return img4, labels4
+    return mosaic_release(self, img4), labels4
 
 
+@profiled('mosaic')
 def load_mosaic9(self, index):
     # loads images in a 9-mosaic
 
-    labels9, segments9 = [], []
+    tiles = []  # (w, h, padx, pady) per tile
     s = self.img_size
     indices = [index] + random.choices(self.indices, k=8)  # 8 additional image indices
     for i, index in enumerate(indices):
@@ -776,7 +910,7 @@ def load_mosaic9(self, index):
 
         # place img in img9
         if i == 0:  # center
-            img9 = np.full((s * 3, s * 3, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
+            img9 = mosaic_canvas(self, (s * 3, s * 3, img.shape[2]))  # base image with 9 tiles
             h0, w0 = h, w
             c = s, s, s + w, s + h  # xmin, ymin, xmax, ymax (base) coordinates
         elif i == 1:  # top
@@ -798,14 +932,7 @@ def load_mosaic9(self, index):
 
         padx, pady = c[:2]
         x1, y1, x2, y2 = [max(x, 0) for x in c]  # allocate coords
-
-        # Labels
-        labels, segments = self.labels[index].copy(), self.segments[index].copy()
-        if labels.size:
-            labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padx, pady)  # normalized xywh to pixel xyxy format
-            segments = [xyn2xy(x, w, h, padx, pady) for x in segments]
-        labels9.append(labels)
-        segments9.extend(segments)
+        tiles.append([w, h, padx, pady])
 
         # Image
         img9[y1:y2, x1:x2] = img[y1 - pady:, x1 - padx:]  # img9[ymin:ymax, xmin:xmax]
@@ -815,35 +942,33 @@ def load_mosaic9(self, index):
     yc, xc = [int(random.uniform(0, s)) for _ in self.mosaic_border]  # mosaic center x, y
     img9 = img9[yc:yc + 2 * s, xc:xc + 2 * s]
 
-    # Concat/clip labels
-    labels9 = np.concatenate(labels9, 0)
-    labels9[:, [1, 3]] -= xc
-    labels9[:, [2, 4]] -= yc
-    c = np.array([xc, yc])  # centers
-    segments9 = [x - c for x in segments9]
-
-    for x in (labels9[:, 1:], *segments9):
-        np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
+    # Labels
+    tiles = [(w, h, padx - xc, pady - yc) for w, h, padx, pady in tiles]  # offset pads by mosaic center
+    labels9, segments9 = mosaic_labels(self, indices, tiles)  # clip when using random_perspective()
     # img9, labels9 = replicate(img9, labels9)  # replicate
 
     # Augment
     #img9, labels9, segments9 = remove_background(img9, labels9, segments9)
     img9, labels9, segments9 = copy_paste(img9, labels9, segments9, probability=self.hyp['copy_paste'])
-    img9, labels9 = random_perspective(img9, labels9, segments9,
-                                       degrees=self.hyp['degrees'],
-                                       translate=self.hyp['translate'],
-                                       scale=self.hyp['scale'],
-                                       shear=self.hyp['shear'],
-                                       perspective=self.hyp['perspective'],
-                                       border=self.mosaic_border)  # border to remove
+    with self.profile('perspective'):
+        if self.fused_augment:
+            img9, labels9 = fused_perspective(img9, labels9, segments9, self.hyp, border=self.mosaic_border)
+        else:
+            img9, labels9 = random_perspective(img9, labels9, segments9,
+                                               degrees=self.hyp['degrees'],
+                                               translate=self.hyp['translate'],
+                                               scale=self.hyp['scale'],
+                                               shear=self.hyp['shear'],
+                                               perspective=self.hyp['perspective'],
+                                               border=self.mosaic_border)  # border to remove
 
-    return img9, labels9
+    return mosaic_release(self, img9), labels9
 
 
 def load_samples(self, index):
     # loads images in a 4-mosaic
 
-    labels4, segments4 = [], []
+    tiles = []  # (w, h, padw, padh) per tile
     s = self.img_size
     yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
     indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
@@ -853,7 +978,7 @@ def load_samples(self, index):
 
         # place img in img4
         if i == 0:  # top left
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
+            img4 = mosaic_canvas(self, (s * 2, s * 2, img.shape[2]))  # base image with 4 tiles
             x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
             x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
         elif i == 1:  # top right
@@ -867,21 +992,10 @@ def load_samples(self, index):
             x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
         img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
-        padw = x1a - x1b
-        padh = y1a - y1b
-
-        # Labels
-        labels, segments = self.labels[index].copy(), self.segments[index].copy()
-        if labels.size:
-            labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
-            segments = [xyn2xy(x, w, h, padw, padh) for x in segments]
-        labels4.append(labels)
-        segments4.extend(segments)
-
-    # Concat/clip labels
-    labels4 = np.concatenate(labels4, 0)
-    for x in (labels4[:, 1:], *segments4):
-        np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
+        tiles.append((w, h, x1a - x1b, y1a - y1b))  # w, h, padw, padh
+
+    # Labels
+    labels4, segments4 = mosaic_labels(self, indices, tiles)  # clip when using random_perspective()
     # img4, labels4 = replicate(img4, labels4)  # replicate
 
     # Augment
@@ -1019,13 +1133,31 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
     # targets = [cls, xyxy]
 
-    height = img.shape[0] + border[0] * 2  # shape(h,w,c)
-    width = img.shape[1] + border[1] * 2
+    M, s, width, height = random_perspective_matrix(img.shape[:2], degrees, translate, scale, shear, perspective, border)
+    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
+        if perspective:
+            img = cv2.warpPerspective(img, M, dsize=(width, height), borderValue=(114, 114, 114))
+        else:  # affine
+            img = cv2.warpAffine(img, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+
+    # Visualize
+    # import matplotlib.pyplot as plt
+    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
+    # ax[0].imshow(img[:, :, ::-1])  # base
+    # ax[1].imshow(img2[:, :, ::-1])  # warped
+
+    return img, warp_targets(targets, segments, M, s, width, height, perspective)
+
+
+def random_perspective_matrix(shape, degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0, border=(0, 0)):
+    # Random random_perspective() homography for an image of shape (h, w). Returns M, scale and output width, height
+    height = shape[0] + border[0] * 2  # shape(h,w,c)
+    width = shape[1] + border[1] * 2
 
     # Center
     C = np.eye(3)
-    C[0, 2] = -img.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -img.shape[0] / 2  # y translation (pixels)
+    C[0, 2] = -shape[1] / 2  # x translation (pixels)
+    C[1, 2] = -shape[0] / 2  # y translation (pixels)
 
     # Perspective
     P = np.eye(3)
@@ -1052,33 +1184,79 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
 
     # Combined rotation matrix
     M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
-    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
+    return M, s, width, height
+
+
+def random_flip_matrix(width, height, flipud=0.0, fliplr=0.0):
+    # Random up-down and left-right flips of a width x height image as a 3x3 matrix (flip probabilities)
+    F = np.eye(3)
+    if random.random() < flipud:
+        F[1, 1], F[1, 2] = -1, height
+    if random.random() < fliplr:
+        F[0, 0], F[0, 2] = -1, width
+    return F
+
+
+def letterbox_matrix(shape, new_shape=(640, 640), scaleup=True):
+    # letterbox(auto=False) of an image of shape (h, w) as a 3x3 matrix. Returns M, new shape (h, w), ratio and padding
+    if isinstance(new_shape, int):
+        new_shape = (new_shape, new_shape)
+    new_shape = int(new_shape[0]), int(new_shape[1])
+
+    # Scale ratio (new / old)
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    if not scaleup:  # only scale down, do not scale up (for better test mAP)
+        r = min(r, 1.0)
+
+    # Compute padding
+    new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+    dw, dh = (new_shape[1] - new_unpad[0]) / 2, (new_shape[0] - new_unpad[1]) / 2  # wh padding, divided into 2 sides
+
+    M = np.eye(3)
+    M[0, 0], M[1, 1] = new_unpad[0] / shape[1], new_unpad[1] / shape[0]  # resize
+    M[0, 2], M[1, 2] = int(round(dw - 0.1)), int(round(dh - 0.1))  # left, top border
+    return M, new_shape, (r, r), (dw, dh)
+
+
+def fused_perspective(img, targets=(), segments=(), hyp=None, border=(0, 0), pre=None, shape=None):
+    # random_perspective() with the flips (and an optional letterbox_matrix() 'pre' transform of an image whose
+    # transformed shape is 'shape') composed into a single warp, so each sample is resampled once
+    perspective = hyp['perspective']
+    M, s, width, height = random_perspective_matrix(shape or img.shape[:2], hyp['degrees'], hyp['translate'],
+                                                    hyp['scale'], hyp['shear'], perspective, border)
+    F = random_flip_matrix(width, height, hyp['flipud'], hyp['fliplr'])
+    Fi = F.copy()
+    Fi[:2, 2] = (Fi[:2, 2] - 1).clip(0)  # flip image pixel centres, x -> w - 1 - x
+    M, Mi = F @ M, Fi @ M
+    if pre is not None:
+        Mi = Mi @ pre  # image is in pre-'pre' space, targets are already in 'pre' space
+    if pre is not None or (height, width) != img.shape[:2] or (Mi != np.eye(3)).any():  # image changed
         if perspective:
-            img = cv2.warpPerspective(img, M, dsize=(width, height), borderValue=(114, 114, 114))
+            img = cv2.warpPerspective(img, Mi, dsize=(width, height), borderValue=(114, 114, 114))
         else:  # affine
-            img = cv2.warpAffine(img, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+            img = cv2.warpAffine(img, Mi[:2], dsize=(width, height), borderValue=(114, 114, 114))
+
+    return img, warp_targets(targets, segments, M, s, width, height, perspective)
 
-    # Visualize
-    # import matplotlib.pyplot as plt
-    # ax = plt.subplots(1, 2, figsize=(12, 6))[1].ravel()
-    # ax[0].imshow(img[:, :, ::-1])  # base
-    # ax[1].imshow(img2[:, :, ::-1])  # warped
 
-    # Transform label coordinates
+def warp_targets(targets, segments, M, s, width, height, perspective=0.0):
+    # Transform targets [cls, xyxy] (or their segments) by M, clip to width x height and drop degenerate boxes
     n = len(targets)
     if n:
         use_segments = any(x.any() for x in segments)
         new = np.zeros((n, 4))
-        if use_segments:  # warp segments
-            segments = resample_segments(segments)  # upsample
-            for i, segment in enumerate(segments):
-                xy = np.ones((len(segment), 3))
-                xy[:, :2] = segment
+        if use_segments:  # warp segments, all at once as an (m,1000,2) array
+            segments = resample_segments_packed(*pack_segments(segments))  # upsample
+            if perspective:
+                xy = np.ones((*segments.shape[:2], 3))
+                xy[..., :2] = segments
                 xy = xy @ M.T  # transform
-                xy = xy[:, :2] / xy[:, 2:3] if perspective else xy[:, :2]  # perspective rescale or affine
+                xy = xy[..., :2] / xy[..., 2:3]  # perspective rescale
+            else:  # affine
+                xy = segments @ M[:2, :2].T + M[:2, 2]
 
-                # clip
-                new[i] = segment2box(xy, width, height)
+            # clip
+            new[:len(xy)] = segments2box(xy, width, height)
 
         else:  # warp boxes
             xy = np.ones((n * 4, 3))
@@ -1100,7 +1278,7 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
         targets = targets[i]
         targets[:, 1:5] = new[i]
 
-    return img, targets
+    return targets
 
 
 def box_candidates(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.1, eps=1e-16):  # box1(4,n), box2(4,n)
@@ -1215,6 +1393,88 @@ def pastein(image, labels, sample_labels, sample_images, sample_masks):
 
     return labels
 
+class DeviceAugment:
+    # Batched HSV, flip and affine augmentation of collated (imgs, targets) on the training device, see --device-augment
+    def __init__(self, hyp):
+        self.hyp = hyp
+
+    def __call__(self, imgs, targets, warp=None):
+        # imgs(bs,3,h,w) RGB 0.0-1.0, targets(n,6) [image, class, xywh normalized], warp(bs) images to affine-warp
+        hyp = self.hyp
+        bs, _, h, w = imgs.shape
+        if warp is not None and len(warp) == bs and any(warp):
+            imgs, targets = self.affine(imgs, targets, torch.tensor(warp, device=imgs.device))
+        imgs = self.hsv(imgs, hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v'])
+
+        # Flips
+        j = targets[:, 0].long()  # image index of each target
+        for p, dim, col in (hyp['flipud'], 2, 3), (hyp['fliplr'], 3, 2):  # up-down (y), left-right (x)
+            flip = torch.rand(bs, device=imgs.device) < p
+            if flip.any():
+                imgs[flip] = imgs[flip].flip(dim)
+                i = flip[j]
+                targets[i, col] = 1 - targets[i, col]
+        return imgs, targets
+
+    @staticmethod
+    def hsv(imgs, hgain=0.5, sgain=0.5, vgain=0.5, eps=1e-8):
+        # augment_hsv() on a batch: random per-image hue rotation, saturation and value gains
+        r = (torch.rand(len(imgs), 3, 1, 1, device=imgs.device) * 2 - 1) * \
+            torch.tensor([hgain, sgain, vgain], device=imgs.device).view(1, 3, 1, 1) + 1  # random gains
+        red, green, blue = imgs.unbind(1)
+        v, vi = imgs.max(1)  # value, index of max channel
+        d = v - imgs.min(1)[0]
+        s = d / (v + eps)  # saturation
+        hue = torch.where(vi == 0, (green - blue) / (d + eps),
+                          torch.where(vi == 1, (blue - red) / (d + eps) + 2, (red - green) / (d + eps) + 4))
+        hue = (hue / 6) % 1.0
+
+        hue = (hue * r[:, 0]) % 1.0
+        s = (s * r[:, 1]).clamp(0, 1)
+        v = (v * r[:, 2]).clamp(0, 1)
+
+        k = (torch.tensor([5, 3, 1], device=imgs.device).view(1, 3, 1, 1) + hue.unsqueeze(1) * 6) % 6  # r, g, b
+        return v.unsqueeze(1) - (v * s).unsqueeze(1) * torch.min(k, 4 - k).clamp(0, 1)
+
+    def affine(self, imgs, targets, warp):
+        # random_perspective() (affine only) of the images selected by warp(bs), targets transformed and filtered
+        hyp = self.hyp
+        bs, _, h, w = imgs.shape
+        M, s = torch.eye(3).repeat(bs, 1, 1), torch.ones(bs)
+        for i in warp.nonzero(as_tuple=False).view(-1).tolist():
+            Mi, s[i] = random_perspective_matrix((h, w), hyp['degrees'], hyp['translate'], hyp['scale'],
+                                                 hyp['shear'])[:2]
+            M[i] = torch.from_numpy(Mi)
+
+        # Images, output-to-input normalized coordinates for grid_sample()
+        N = torch.tensor([[2 / w, 0, -1], [0, 2 / h, -1], [0, 0, 1]])  # pixels to normalized (-1, 1)
+        theta = (N @ torch.linalg.inv(M) @ torch.linalg.inv(N))[warp.cpu(), :2].to(imgs)
+        grid = F.affine_grid(theta, [len(theta), 3, h, w], align_corners=False)
+        pad = 114 / 255
+        imgs[warp] = F.grid_sample(imgs[warp] - pad, grid, align_corners=False) + pad  # pad with 114
+
+        # Targets
+        if len(targets):
+            M, s = M.to(targets.device, targets.dtype), s.to(targets.device, targets.dtype)
+            j = targets[:, 0].long()
+            box = xywh2xyxy(targets[:, 2:6]) * torch.tensor([w, h, w, h], device=targets.device)
+            xy = torch.ones(len(box), 4, 3, device=targets.device, dtype=targets.dtype)
+            xy[..., :2] = box[:, [0, 1, 2, 3, 0, 3, 2, 1]].view(-1, 4, 2)  # x1y1, x2y2, x1y2, x2y1
+            xy = (xy @ M[j].transpose(1, 2))[..., :2]  # transform
+            new = torch.cat((xy.min(1)[0], xy.max(1)[0]), 1)
+            new[:, [0, 2]] = new[:, [0, 2]].clamp(0, w)
+            new[:, [1, 3]] = new[:, [1, 3]].clamp(0, h)
+
+            # filter candidates, as box_candidates()
+            w1, h1 = (box[:, 2:] - box[:, :2]).T * s[j]
+            w2, h2 = (new[:, 2:] - new[:, :2]).T
+            ar = torch.max(w2 / (h2 + 1e-16), h2 / (w2 + 1e-16))  # aspect ratio
+            i = (w2 > 2) & (h2 > 2) & (w2 * h2 / (w1 * h1 + 1e-16) > 0.1) & (ar < 20)
+            targets[:, 2:6] = xyxy2xywh(new) / torch.tensor([w, h, w, h], device=targets.device)
+            targets = targets[i | ~warp.to(targets.device)[j]]
+        return imgs, targets
+
+
 class Albumentations:
     # YOLOv5 Albumentations class (optional, only used if package is installed)
     def __init__(self):
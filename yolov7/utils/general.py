@@ -298,6 +298,16 @@ def segment2box(segment, width=640, height=640):
     return np.array([x.min(), y.min(), x.max(), y.max()]) if any(x) else np.zeros((1, 4))  # xyxy
 
 
+def segments2box(segments, width=640, height=640):
+    # Batched segment2box() for an (m,n,2) array of equal-length segments, returns (m,4) xyxy
+    x, y = segments[..., 0], segments[..., 1]
+    inside = (x >= 0) & (y >= 0) & (x <= width) & (y <= height)
+    boxes = np.stack((np.where(inside, x, np.inf).min(1), np.where(inside, y, np.inf).min(1),
+                      np.where(inside, x, -np.inf).max(1), np.where(inside, y, -np.inf).max(1)), 1)
+    boxes[~(inside & (x != 0)).any(1)] = 0  # no (non-zero) points inside image, as in segment2box()
+    return boxes
+
+
 def segments2boxes(segments):
     # Convert segment labels to box labels, i.e. (cls, xy1, xy2, ...) to (cls, xywh)
     boxes = []
@@ -307,16 +317,36 @@ def segments2boxes(segments):
     return xyxy2xywh(np.array(boxes))  # cls, xywh
 
 
+def pack_segments(segments):
+    # Concatenate a list of (n,2) segments into one (N,2) array plus the split offsets to recover them
+    if not len(segments):
+        return np.zeros((0, 2), dtype=np.float32), np.zeros(0, dtype=np.int64)
+    return np.concatenate(segments, 0), np.cumsum([len(x) for x in segments])[:-1]
+
+
+def unpack_segments(xy, offsets):
+    # Split a packed (N,2) segment array back into a list of (n,2) segments (views), inverse of pack_segments()
+    return np.split(xy, offsets) if len(xy) else []
+
+
 def resample_segments(segments, n=1000):
-    # Up-sample an (n,2) segment
-    for i, s in enumerate(segments):
-        s = np.concatenate((s, s[0:1, :]), axis=0)
-        x = np.linspace(0, len(s) - 1, n)
-        xp = np.arange(len(s))
-        segments[i] = np.concatenate([np.interp(x, xp, s[:, i]) for i in range(2)]).reshape(2, -1).T  # segment xy
+    # Up-sample a list of (k,2) segments to n points each
+    segments[:] = resample_segments_packed(*pack_segments(segments), n=n)
     return segments
 
 
+def resample_segments_packed(xy, offsets, n=1000):
+    # Up-sample all segments of a pack_segments() array with a single interpolation, returns an (m,n,2) array
+    if not len(xy):
+        return np.zeros((0, n, 2))
+    start = np.concatenate(([0], offsets))  # first point of each segment
+    k = np.diff(np.concatenate((start, [len(xy)])))  # points per segment
+    closed = np.insert(xy, np.concatenate((offsets, [len(xy)])), xy[start], axis=0)  # repeat first point at the end
+    x = (np.linspace(0, 1, n) * k[:, None] + (start + np.arange(len(k)))[:, None]).ravel()  # positions in 'closed'
+    xp = np.arange(len(closed))
+    return np.stack([np.interp(x, xp, closed[:, i]) for i in range(2)], 1).reshape(len(k), n, 2)  # segment xy
+
+
 def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
     # Rescale coords (xyxy) from img1_shape to img0_shape
     if ratio_pad is None:  # calculate from img0_shape
@@ -606,8 +636,9 @@ def box_diou(box1, box2, eps: float = 1e-7):
 
 
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=()):
-    """Runs Non-Maximum Suppression (NMS) on inference results
+                        labels=(), merge=False):
+    """Runs Non-Maximum Suppression (NMS) on inference results, with merge each kept box becomes the score-weighted
+    mean of the boxes it suppresses (weighted box fusion, i.e. of test-time augmentation views)
 
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
@@ -623,7 +654,6 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     time_limit = 10.0  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
 
     t = time.time()
     output = [torch.zeros((0, 6), device=prediction.device)] * prediction.shape[0]
@@ -684,7 +714,7 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
         i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
         if i.shape[0] > max_det:  # limit detections
             i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
+        if merge and n > 1:  # Merge NMS (boxes merged using weighted mean), at most max_det x max_nms IoUs
             # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
             iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
             weights = iou * scores[None]  # box weights
@@ -700,6 +730,36 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
+def weighted_boxes_fusion(detections, weights=None, iou_thres=0.55):
+    """Weighted box fusion (https://arxiv.org/abs/1910.13302) of the detections of several models on one image. Boxes
+    of the same class overlapping by more than iou_thres form a cluster which becomes its score-weighted mean box, with
+    the mean score times min(boxes, models) / models as confidence, i.e. boxes found by fewer models are down-weighted.
+    Clusters are seeded by NMS and boxes join the seed they overlap most, not by the sequential matching of the paper
+
+    Arguments:
+        detections: list of (n,6) tensors [xyxy, conf, cls], one per model, e.g. from non_max_suppression()
+        weights: list of model weights scaling their scores, None for equal weights
+
+    Returns:
+         (n,6) tensor of fused detections [xyxy, conf, cls]
+    """
+    x = torch.cat(detections, 0)
+    if not x.shape[0]:
+        return x
+    weights = torch.tensor(weights or [1.0] * len(detections), device=x.device, dtype=x.dtype)
+    scores = x[:, 4] * torch.cat([w.expand(len(d)) for w, d in zip(weights, detections)])
+    boxes = x[:, :4] + x[:, 5:6] * 4096  # boxes offset by class (max_wh)
+    i = torchvision.ops.nms(boxes, scores, iou_thres)  # cluster seeds
+    j = box_iou(boxes[i], boxes).argmax(0)  # cluster of each box, every box overlaps a seed by more than iou_thres
+
+    # Fuse clusters
+    s = x.new_zeros(len(i)).index_add_(0, j, scores)  # score sums
+    n = x.new_zeros(len(i)).index_add_(0, j, torch.ones_like(scores))  # boxes per cluster
+    box = x.new_zeros(len(i), 4).index_add_(0, j, x[:, :4] * scores[:, None]) / s[:, None]
+    conf = s / n * n.clamp(max=len(detections)) / weights.sum()
+    return torch.cat((box, conf[:, None], x[i, 5:6]), 1)
+
+
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
                         labels=(), kpt_label=False, nc=None, nkpt=None):
     """Runs Non-Maximum Suppression (NMS) on inference results
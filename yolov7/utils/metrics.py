@@ -15,7 +15,8 @@ def fitness(x):
     return (x[:, :4] * w).sum(1)
 
 
-def ap_per_class(tp, conf, pred_cls, target_cls, v5_metric=False, plot=False, save_dir='.', names=()):
+def ap_per_class(tp, conf, pred_cls, target_cls, v5_metric=False, plot=False, save_dir='.', names=(), n=None,
+                 nl=None):
     """ Compute the average precision, given the recall and precision curves.
     Source: https://github.com/rafaelpadilla/Object-Detection-Metrics.
     # Arguments
@@ -25,59 +26,98 @@ def ap_per_class(tp, conf, pred_cls, target_cls, v5_metric=False, plot=False, sa
         target_cls:  True object classes (nparray).
         plot:  Plot precision-recall curve at mAP@0.5
         save_dir:  Plot save directory
+        n:  Number of predictions per row, tp then holds true positive counts (nparray, optional, i.e. histograms)
+        nl:  Number of labels per target_cls entry, target_cls then holds sorted unique classes (nparray, optional)
     # Returns
         The average precision as computed in py-faster-rcnn.
     """
 
-    # Sort by objectness
-    i = np.argsort(-conf)
-    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
-
     # Find unique classes
-    unique_classes = np.unique(target_cls)
+    unique_classes, n_l = np.unique(target_cls, return_counts=True) if nl is None else (target_cls, nl)  # classes, labels
     nc = unique_classes.shape[0]  # number of classes, number of detections
 
+    # Sort by objectness, then by class so that every labelled class is a contiguous, objectness-sorted segment
+    i = np.argsort(-conf)
+    i = i[np.argsort(pred_cls[i], kind='stable')]
+    i = i[np.isin(pred_cls[i], unique_classes)]
+    tp, conf, pred_cls = tp[i], conf[i].astype(np.float64), pred_cls[i]
+    n = 1 if n is None else n[i].reshape(-1, 1)
+    ci = np.searchsorted(unique_classes, pred_cls)  # class index
+    cls, seg = np.unique(ci, return_inverse=True)  # segments are the classes with any prediction
+    seg, ns = seg.reshape(-1), cls.shape[0]  # segment of each prediction, number of segments
+    start = np.searchsorted(seg, np.arange(ns))  # first prediction of each segment
+    end = np.append(start[1:], len(seg)) - 1  # last prediction of each segment
+
     # Create Precision-Recall curve and compute AP for each class
     px, py = np.linspace(0, 1, 1000), []  # for plotting
     ap, p, r = np.zeros((nc, tp.shape[1])), np.zeros((nc, 1000)), np.zeros((nc, 1000))
-    for ci, c in enumerate(unique_classes):
-        i = pred_cls == c
-        n_l = (target_cls == c).sum()  # number of labels
-        n_p = i.sum()  # number of predictions
-
-        if n_p == 0 or n_l == 0:
-            continue
-        else:
-            # Accumulate FPs and TPs
-            fpc = (1 - tp[i]).cumsum(0)
-            tpc = tp[i].cumsum(0)
-
-            # Recall
-            recall = tpc / (n_l + 1e-16)  # recall curve
-            r[ci] = np.interp(-px, -conf[i], recall[:, 0], left=0)  # negative x, xp because xp decreases
-
-            # Precision
-            precision = tpc / (tpc + fpc)  # precision curve
-            p[ci] = np.interp(-px, -conf[i], precision[:, 0], left=1)  # p at pr_score
-
-            # AP from recall-precision curve
-            for j in range(tp.shape[1]):
-                ap[ci, j], mpre, mrec = compute_ap(recall[:, j], precision[:, j], v5_metric=v5_metric)
-                if plot and j == 0:
-                    py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
+    if ns:
+        # Accumulate predictions and TPs per segment
+        npc, tpc = np.broadcast_to(n, (len(seg), 1)).cumsum(0), tp.cumsum(0)  # predictions, TPs
+        if ns > 1:
+            npc -= np.concatenate((np.zeros_like(npc[:1]), npc[start[1:] - 1]))[seg]
+            tpc -= np.concatenate((np.zeros_like(tpc[:1]), tpc[start[1:] - 1]))[seg]
+
+        # Recall
+        recall = tpc / (n_l[ci][:, None] + 1e-16)  # recall curve
+        r[cls] = segment_interp(-px, -conf, recall[:, 0], seg, ns, left=0)  # negative x, xp because xp decreases
+
+        # Precision
+        precision = tpc / npc  # precision curve, TPs / (TPs + FPs)
+        p[cls] = segment_interp(-px, -conf, precision[:, 0], seg, ns, left=1)  # p at pr_score
+
+        # AP from recall-precision curve, for all segments and IoU thresholds at once
+        mrec, mpre, mseg = ap_envelope(recall, precision, seg, start, end, v5_metric)
+        x = np.linspace(0, 1, 101)  # 101-point interp (COCO)
+        k = np.arange(tp.shape[1])[:, None] * ns + mseg  # (threshold, segment) segments, threshold major
+        y = segment_interp(x, mrec.reshape(-1), mpre.reshape(-1), k.reshape(-1), tp.shape[1] * ns)
+        ap[cls] = np.trapz(y, x).reshape(tp.shape[1], ns).T  # integrate
+        if plot:
+            py = list(segment_interp(px, mrec[0], mpre[0], mseg, ns))  # precision at mAP@0.5
 
     # Compute F1 (harmonic mean of precision and recall)
     f1 = 2 * p * r / (p + r + 1e-16)
-    if plot:
-        plot_pr_curve(px, py, ap, Path(save_dir) / 'PR_curve.png', names)
-        plot_mc_curve(px, f1, Path(save_dir) / 'F1_curve.png', names, ylabel='F1')
-        plot_mc_curve(px, p, Path(save_dir) / 'P_curve.png', names, ylabel='Precision')
-        plot_mc_curve(px, r, Path(save_dir) / 'R_curve.png', names, ylabel='Recall')
+    if plot:  # rendered in the background
+        from utils.plots import plot_pool  # utils.plots imports this module
+        plot_pool.submit(plot_pr_curve, px, py, ap, Path(save_dir) / 'PR_curve.png', names)
+        plot_pool.submit(plot_mc_curve, px, f1, Path(save_dir) / 'F1_curve.png', names, ylabel='F1')
+        plot_pool.submit(plot_mc_curve, px, p, Path(save_dir) / 'P_curve.png', names, ylabel='Precision')
+        plot_pool.submit(plot_mc_curve, px, r, Path(save_dir) / 'R_curve.png', names, ylabel='Recall')
 
     i = f1.mean(0).argmax()  # max F1 index
     return p[:, i], r[:, i], ap, f1[:, i], unique_classes.astype('int32')
 
 
+def segment_interp(x, xp, fp, seg, ns, left=None):
+    # np.interp(x, xp[seg == i], fp[seg == i], left=left) for all segments i < ns at once, returns (ns, len(x))
+    # seg must be sorted and xp increasing within each segment, i.e. curves concatenated one after another
+    i = np.arange(ns)[:, None]
+    j = np.searchsorted(seg + 1j * xp, i + 1j * x, side='right') - 1  # xp[j] <= x, complex sorts lexicographically
+    start, end = np.searchsorted(seg, i), np.searchsorted(seg, i, side='right') - 1
+    k = np.minimum(j + 1, end)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = (fp[k] - fp[j]) / (xp[k] - xp[j]) * (x - xp[j]) + fp[j]  # same arithmetic as np.interp
+    y = np.where(j >= end, fp[end], y)
+    return np.where(j < start, fp[start] if left is None else left, y)
+
+
+def ap_envelope(recall, precision, seg, start, end, v5_metric=False):
+    # compute_ap() sentinels and precision envelope for the segmented (n, thresholds) curves of ap_per_class(),
+    # returns (thresholds, n + 2 * segments) recall and precision and the segment of each column
+    ns = len(start)
+    i = np.arange(len(seg)) + 2 * seg + 1  # columns after inserting 2 sentinels per segment
+    first, last = start + 2 * np.arange(ns), end + 2 * np.arange(ns) + 2
+    mrec, mpre = np.zeros((2, recall.shape[1], len(seg) + 2 * ns))
+    mrec[:, i], mpre[:, i], mpre[:, first] = recall.T, precision.T, 1.
+    mrec[:, last] = 1. if v5_metric else recall[end].T + 0.01
+    mseg = np.repeat(np.arange(ns), last - first + 1)
+
+    # Compute the precision envelope, per segment for all thresholds at once
+    for f, l in zip(first, last + 1):
+        mpre[:, f:l] = np.flip(np.maximum.accumulate(np.flip(mpre[:, f:l], 1), 1), 1)
+    return mrec, mpre, mseg
+
+
 def compute_ap(recall, precision, v5_metric=False):
     """ Compute the average precision, given the recall and precision curves
     # Arguments
@@ -110,6 +150,71 @@ def compute_ap(recall, precision, v5_metric=False):
     return ap, mpre, mrec
 
 
+def match_predictions(detections, labels, iouv):
+    """ Greedy prediction-to-target matching at all IoU thresholds at once, without host syncs.
+    Each detection is matched to its best same-class label if their IoU exceeds iouv[0] and no earlier
+    (higher confidence) detection already claimed that label.
+    Arguments:
+        detections (Array[N, 6]), x1, y1, x2, y2, conf, class, sorted by descending confidence (NMS output)
+        labels (Array[M, 5]), class, x1, y1, x2, y2
+        iouv (Array[K]), IoU thresholds
+    Returns:
+        correct (Array[N, K]), bool, true positives at each IoU threshold
+    """
+    n, m = detections.shape[0], labels.shape[0]
+    iou = general.box_iou(detections[:, :4], labels[:, 1:])  # (N, M)
+    iou[detections[:, 5:6] != labels[:, 0]] = -1.  # only match same class
+    best, ti = iou.max(1) if m else (torch.zeros(n, device=iou.device), torch.zeros(n, dtype=torch.long, device=iou.device))
+    valid = best > iouv[0]
+
+    # First (highest confidence) valid detection per label claims it
+    idx = torch.arange(n, device=iou.device)
+    key, order = torch.sort(torch.where(valid, ti, torch.full_like(ti, m)) * n + idx)  # by label, then confidence
+    group = key // n
+    first = torch.ones_like(valid)
+    first[1:] = group[1:] != group[:-1]
+    claimed = torch.zeros_like(valid).scatter(0, order, first) & valid
+    return claimed[:, None] & (best[:, None] > iouv)
+
+
+class APAccumulator:
+    # Streaming mAP statistics as per-class confidence histograms, memory is O(nc * bins) regardless of dataset size
+    def __init__(self, nc, niou=10, bins=10000, device='cpu'):
+        self.nc, self.bins = nc, bins
+        self.tp = torch.zeros(nc, bins, niou, dtype=torch.long, device=device)  # true positives per confidence bin
+        self.n = torch.zeros(nc, bins, dtype=torch.long, device=device)  # predictions per confidence bin
+        self.nl = torch.zeros(nc, dtype=torch.long, device=device)  # labels per class
+
+    def update(self, correct, conf, pred_cls, target_cls):
+        # Add the statistics of one image, arguments as the (correct, conf, pcls, tcls) tuples in test.py
+        device = self.n.device
+        c = pred_cls.to(device).long()
+        b = (conf.to(device) * self.bins).long().clamp_(0, self.bins - 1)  # confidence bin
+        self.n.index_put_((c, b), torch.ones_like(c), accumulate=True)
+        self.tp.index_put_((c, b), correct.to(device).long(), accumulate=True)
+        self.nl += torch.bincount(torch.as_tensor(target_cls, device=device).long(), minlength=self.nc)
+
+    def merge(self, other):
+        # Add the statistics of another accumulator, i.e. a partial result from another process
+        for x, y in zip((self.tp, self.n, self.nl), (other.tp, other.n, other.nl)):
+            x += y.to(x.device)
+        return self
+
+    def all_reduce(self):
+        # Sum statistics over all DDP processes
+        for x in self.tp, self.n, self.nl:
+            torch.distributed.all_reduce(x)
+        return self
+
+    def compute(self, v5_metric=False, plot=False, save_dir='.', names=()):
+        # ap_per_class() on the occupied bins, one precision-recall point per bin
+        n, nl = self.n.cpu().numpy(), self.nl.cpu().numpy()
+        c, b = n.nonzero()  # occupied bins
+        cl = nl.nonzero()[0]  # classes with labels
+        return ap_per_class(self.tp.cpu().numpy()[c, b], (b + 0.5) / self.bins, c, cl, v5_metric=v5_metric,
+                            plot=plot, save_dir=save_dir, names=names, n=n[c, b], nl=nl[cl])
+
+
 class ConfusionMatrix:
     # Updated version of https://github.com/kaanakan/object_detection_confusion_matrix
     def __init__(self, nc, conf=0.25, iou_thres=0.45):
@@ -145,18 +250,17 @@ class ConfusionMatrix:
             matches = np.zeros((0, 3))
 
         n = matches.shape[0] > 0
-        m0, m1, _ = matches.transpose().astype(np.int16)
-        for i, gc in enumerate(gt_classes):
-            j = m0 == i
-            if n and sum(j) == 1:
-                self.matrix[gc, detection_classes[m1[j]]] += 1  # correct
-            else:
-                self.matrix[self.nc, gc] += 1  # background FP
+        m0, m1, _ = matches.transpose().astype(int)
+        gt_classes, detection_classes = gt_classes.cpu().numpy(), detection_classes.cpu().numpy()
+        matched = np.zeros(len(gt_classes), dtype=bool)
+        matched[m0] = True
+        np.add.at(self.matrix, (gt_classes[m0], detection_classes[m1]), 1)  # correct
+        np.add.at(self.matrix, (self.nc, gt_classes[~matched]), 1)  # background FP
 
         if n:
-            for i, dc in enumerate(detection_classes):
-                if not any(m1 == i):
-                    self.matrix[dc, self.nc] += 1  # background FN
+            detected = np.zeros(len(detection_classes), dtype=bool)
+            detected[m1] = True
+            np.add.at(self.matrix, (detection_classes[~detected], self.nc), 1)  # background FN
 
     def matrix(self):
         return self.matrix
@@ -177,6 +281,7 @@ class ConfusionMatrix:
             fig.axes[0].set_xlabel('True')
             fig.axes[0].set_ylabel('Predicted')
             fig.savefig(Path(save_dir) / 'confusion_matrix.png', dpi=250)
+            plt.close(fig)
         except Exception as e:
             pass
 
@@ -205,6 +310,7 @@ def plot_pr_curve(px, py, ap, save_dir='pr_curve.png', names=()):
     ax.set_ylim(0, 1)
     plt.legend(bbox_to_anchor=(1.04, 1), loc="upper left")
     fig.savefig(Path(save_dir), dpi=250)
+    plt.close(fig)
 
 
 def plot_mc_curve(px, py, save_dir='mc_curve.png', names=(), xlabel='Confidence', ylabel='Metric'):
@@ -225,3 +331,4 @@ def plot_mc_curve(px, py, save_dir='mc_curve.png', names=(), xlabel='Confidence'
     ax.set_ylim(0, 1)
     plt.legend(bbox_to_anchor=(1.04, 1), loc="upper left")
     fig.savefig(Path(save_dir), dpi=250)
+    plt.close(fig)
@@ -1,9 +1,16 @@
 # Plotting utils
 
 import glob
+import importlib
 import math
+import multiprocessing
 import os
 import random
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, nullcontext
 from copy import copy
 from pathlib import Path
 
@@ -26,6 +33,60 @@ matplotlib.rc('font', **{'size': 11})
 matplotlib.use('Agg')  # for writing to files only
 
 
+@contextmanager
+def hidden_main():
+    # Hide the caller's __main__ (i.e. train.py, test.py) from processes spawned inside, which would otherwise re-run
+    # its imports by __spec__ name or __file__ path. Functions run there must come from importable modules
+    main = sys.modules['__main__']
+    spec, file = getattr(main, '__spec__', None), main.__dict__.pop('__file__', None)
+    main.__spec__ = None
+    try:
+        yield
+    finally:
+        main.__spec__ = spec
+        if file is not None:
+            main.__file__ = file
+
+
+class PlotPool:
+    # Renders figures in a single background process so that callers never wait on matplotlib, with at most maxsize
+    # figures pending. The process is only started by the first submit(), i.e. never if nothing is plotted
+    def __init__(self, maxsize=16):
+        self.pool, self.pending, self.maxsize = None, deque(), maxsize
+
+    def submit(self, fn, *args, **kwargs):
+        # Queue fn(*args, **kwargs) of an importable module (not __main__), arguments are pickled so pass numpy arrays
+        # or CPU tensors
+        while len(self.pending) >= self.maxsize:  # bounded queue, wait for the oldest figure
+            self.result(self.pending.popleft())
+        try:
+            start = self.pool is None
+            if start:
+                # no fork of CUDA, utils.plots imported first as utils.metrics alone would hit its import cycle
+                self.pool = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=importlib.import_module, initargs=('utils.plots',))
+            with hidden_main() if start else nullcontext():  # the process starts with the first task
+                self.pending.append(self.pool.submit(fn, *args, **kwargs))
+        except BrokenProcessPool as e:  # worker died, restart on the next figure
+            self.pool = None
+            print(f'WARNING: plotting process failed: {e}')
+
+    def join(self):
+        # Wait for all pending figures, i.e. before reading the saved images
+        while self.pending:
+            self.result(self.pending.popleft())
+
+    def result(self, future):
+        try:
+            future.result()
+        except Exception as e:
+            self.pool = None if isinstance(e, BrokenProcessPool) else self.pool
+            print(f'WARNING: plotting failed: {e}')
+
+
+plot_pool = PlotPool()  # shared by all plotting callers of this process
+
+
 def color_list():
     # Return first 10 plt colors as (r,g,b) https://stackoverflow.com/questions/51350872/python-from-color-name-to-rgb
     def hex2rgb(h):
@@ -120,7 +181,7 @@ def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max
         targets = targets.cpu().numpy()
 
     # un-normalise
-    if np.max(images[0]) <= 1:
+    if images.dtype != np.uint8 and np.max(images[0]) <= 1:
         images *= 255
 
     tl = 3  # line thickness
@@ -1,8 +1,13 @@
 # YOLOR PyTorch utils
 
+import csv
 import datetime
+import io
+import itertools
+import json
 import logging
 import math
+import mmap
 import os
 import platform
 import subprocess
@@ -93,6 +98,159 @@ def time_synchronized():
     return time.time()
 
 
+def inference_mode(enabled=True):
+    # torch.inference_mode() context (torch>=1.9, no version counters or view tracking, tensors created inside cannot
+    # be modified in place outside), torch.no_grad() if disabled or not available
+    return torch.inference_mode() if enabled and hasattr(torch, 'inference_mode') else torch.no_grad()
+
+
+class StageTimer:
+    """ CUDA-synchronized wall time samples per named stage, summarized as percentiles. If stages are given, other
+    stages are not timed (no synchronization), e.g. to time only some stages of a loop
+
+    Usage: timer = StageTimer(); with timer('forward'): model(img); timer.print(); timer.save('latency.json')
+    """
+
+    def __init__(self, stages=None):
+        self.times = {k: [] for k in stages or ()}  # stage: seconds per sample, in stage order
+        self.fixed = stages is not None  # only time the given stages
+
+    @contextmanager
+    def __call__(self, stage):
+        if self.fixed and stage not in self.times:
+            yield
+            return
+        t = time_synchronized()
+        try:
+            yield
+        finally:
+            self.add(stage, time_synchronized() - t)
+
+    def add(self, stage, dt):
+        if not self.fixed or stage in self.times:
+            self.times.setdefault(stage, []).append(dt)
+
+    def total(self, stage):
+        return sum(self.times.get(stage, ()))
+
+    def summary(self, percentiles=(50, 90, 99)):
+        # {stage: {n, total, mean, p50, ...}} in ms, stages without samples omitted
+        total = sum(map(sum, self.times.values()))
+        return {k: {'n': len(x), 'total': sum(x) * 1E3, 'share': sum(x) / max(total, 1E-9), 'mean': sum(x) / len(x) * 1E3,
+                    **{f'p{p}': float(torch.tensor(x, dtype=torch.float64).quantile(p / 100)) * 1E3 for p in percentiles}}
+                for k, x in self.times.items() if x}
+
+    def print(self, percentiles=(50, 90, 99)):
+        s = self.summary(percentiles)
+        print(('%20s' + '%12s' * (4 + len(percentiles))) % ('Stage', 'n', 'total ms', 'share', 'mean ms',
+                                                           *(f'p{p} ms' for p in percentiles)))
+        for k, x in s.items():
+            n, total, share, *ms = x.values()
+            print(f'{k:>20s}{n:12d}{total:12.1f}{share:12.1%}' + ''.join(f'{y:12.2f}' for y in ms))
+
+    def save(self, file, percentiles=(50, 90, 99)):
+        with open(file, 'w') as f:
+            json.dump(self.summary(percentiles), f, indent=2)
+
+
+class LayerProfiler:
+    """ Per layer latency, FLOPs, parameters, output bytes and peak CUDA memory of a Model from forward hooks,
+    aggregated over any number of forward passes, exported as CSV, JSON or a Chrome trace (chrome://tracing)
+
+    Usage: with LayerProfiler(model) as p: model(img); p.print(); p.save_csv('layers.csv'); p.save_trace('trace.json')
+    """
+
+    def __init__(self, model):
+        self.layers = model.model  # parse_model() layers, each with .i, .f, .type and .np
+        self.records = [{'time': [], 'flops': [], 'bytes': [], 'memory': [], 'images': []} for _ in self.layers]
+        self.events, self.hooks, self.t0 = [], [], time.perf_counter()  # Chrome trace events
+
+    def __enter__(self):
+        for i, m in enumerate(self.layers):
+            self.hooks.append(m.register_forward_pre_hook(lambda m, x, i=i: self.start(i)))
+            self.hooks.append(m.register_forward_hook(lambda m, x, y, i=i: self.stop(i, x, y)))
+            for c in m.modules():  # FLOPs of the conv and linear layers inside
+                if isinstance(c, (nn.Conv2d, nn.Linear)):
+                    self.hooks.append(c.register_forward_hook(self.count_flops))
+        return self
+
+    def __exit__(self, *args):
+        for h in self.hooks:
+            h.remove()
+        self.hooks = []
+
+    def start(self, i):
+        self.flops, cuda = 0, torch.cuda.is_available()
+        if cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        self.memory = torch.cuda.memory_allocated() if cuda else 0
+        self.t = time.perf_counter()
+
+    def stop(self, i, x, y):
+        cuda = torch.cuda.is_available()
+        if cuda:
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        nbytes = lambda y: y.numel() * y.element_size() if isinstance(y, torch.Tensor) else \
+            sum(nbytes(x) for x in y if x is not None) if isinstance(y, (list, tuple)) else 0
+        x = x[0] if isinstance(x[0], torch.Tensor) else next(v for v in x[0] if v is not None)  # an input tensor
+        r = self.records[i]
+        r['time'].append(t - self.t)
+        r['flops'].append(self.flops)
+        r['bytes'].append(nbytes(y))
+        r['memory'].append(torch.cuda.max_memory_allocated() - self.memory if cuda else 0)
+        r['images'].append(x.shape[0])
+        m = self.layers[i]
+        self.events.append({'name': f'{i} {m.type}', 'ph': 'X', 'pid': 0, 'tid': 0, 'ts': (self.t - self.t0) * 1E6,
+                            'dur': (t - self.t) * 1E6, 'args': {'from': str(m.f), 'GFLOPs': self.flops / 1E9}})
+
+    def count_flops(self, m, x, y):
+        if isinstance(m, nn.Conv2d):  # 2 * MACs
+            self.flops += 2 * y.numel() * m.in_channels // m.groups * m.kernel_size[0] * m.kernel_size[1]
+        else:
+            self.flops += 2 * y.numel() * m.in_features
+
+    def summary(self):
+        # Per layer means, per image for FLOPs and output bytes, per forward pass for time, max for CUDA memory
+        total = sum(sum(r['time']) for r in self.records)
+        rows = []
+        for m, r in zip(self.layers, self.records):
+            if r['time']:
+                n, images, t = len(r['time']), sum(r['images']), torch.tensor(r['time'], dtype=torch.float64) * 1E3
+                rows.append({'layer': m.i, 'from': str(m.f), 'type': m.type, 'params': m.np, 'calls': n,
+                             'GFLOPs': sum(r['flops']) / images / 1E9, 'ms': t.mean().item(),
+                             'p50 ms': t.quantile(0.5).item(), 'p90 ms': t.quantile(0.9).item(),
+                             'share': t.sum().item() / 1E3 / max(total, 1E-9),
+                             'output MB': sum(r['bytes']) / images / 1E6, 'peak CUDA MB': max(r['memory']) / 1E6})
+        return rows
+
+    def print(self):
+        rows = self.summary()
+        print(('%6s%24s  %-40s' + '%10s' * 7) % ('layer', 'from', 'type', 'params', 'GFLOPs', 'ms', 'p90 ms', 'share',
+                                                 'output MB', 'CUDA MB'))
+        for r in rows:
+            print(f"{r['layer']:6d}{r['from']:>24s}  {r['type'][:40]:<40s}{r['params']:10d}{r['GFLOPs']:10.2f}"
+                  f"{r['ms']:10.2f}{r['p90 ms']:10.2f}{r['share']:10.1%}{r['output MB']:10.2f}{r['peak CUDA MB']:10.1f}")
+        print(f"{'total':>6s}{'':24s}  {'':40s}{sum(r['params'] for r in rows):10d}{sum(r['GFLOPs'] for r in rows):10.2f}"
+              f"{sum(r['ms'] for r in rows):10.2f} ms per forward pass")
+
+    def save_csv(self, file):
+        rows = self.summary()
+        with open(file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else [])
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def save_json(self, file):
+        with open(file, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def save_trace(self, file):
+        with open(file, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
 def profile(x, ops, n=100, device=None):
     # profile a pytorch module or list of modules. Example usage:
     #     x = torch.randn(16, 3, 640, 640)  # input
@@ -201,6 +359,47 @@ def fuse_conv_and_bn(conv, bn):
     return fusedconv
 
 
+tensor_dtypes = {'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+                 'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8,
+                 'BOOL': torch.bool}
+
+
+def save_tensors(tensors, file, metadata=None):
+    # Save {name: tensor} in the safetensors format: 8-byte little-endian header size, JSON header with dtype, shape and
+    # data offsets per tensor plus {str: str} __metadata__, then the raw tensor data. The header is padded with spaces
+    # so that data starts 64-byte aligned, tensors are stored by decreasing element size to stay aligned
+    names = {v: k for k, v in tensor_dtypes.items()}
+    tensors = sorted(((k, v.detach().cpu().contiguous()) for k, v in tensors.items()),
+                     key=lambda x: -x[1].element_size())
+    header, offset = {'__metadata__': metadata or {}}, 0
+    for k, v in tensors:
+        header[k] = {'dtype': names[v.dtype], 'shape': list(v.shape), 'data_offsets': [offset, offset + v.nbytes]}
+        offset += v.nbytes
+    header = json.dumps(header, separators=(',', ':')).encode()
+    header += b' ' * (-(8 + len(header)) % 64)
+    with open(file, 'wb') as f:
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for _, v in tensors:
+            f.write(v.reshape(-1).view(torch.uint8).numpy().tobytes() if v.numel() else b'')
+
+
+def load_tensors(file):
+    # Memory-map a save_tensors() / safetensors file. Returns ({name: tensor}, metadata) with CPU tensors backed by the
+    # file's pages (copy-on-write), nothing is read until used and processes loading the same file share memory
+    with open(file, 'rb') as f:
+        n = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(n))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    metadata, tensors = header.pop('__metadata__', {}), {}
+    for k, v in header.items():
+        (start, end), dtype = v['data_offsets'], tensor_dtypes[v['dtype']]
+        count = (end - start) // torch.empty(0, dtype=dtype).element_size()
+        tensors[k] = torch.frombuffer(buffer, dtype=dtype, count=count, offset=8 + n + start).view(v['shape']) \
+            if count else torch.empty(v['shape'], dtype=dtype)
+    return tensors, metadata
+
+
 def model_info(model, verbose=False, img_size=640):
     # Model information. img_size may be int or list, i.e. img_size=640 or img_size=[640, 320]
     n_p = sum(x.numel() for x in model.parameters())  # number parameters
@@ -371,4 +570,54 @@ class TracedModel(nn.Module):
     def forward(self, x, augment=False, profile=False):
         out = self.model(x)
         out = self.detect_layer(out)
-        return out
\ No newline at end of file
+        return out
+
+class QuantizedModel(nn.Module):
+    # Post-training static int8 quantization of a fused Model for CPU inference (FX graph mode, torch>=1.13). Conv, BN
+    # and activations are fused, observers inserted, calibrated on batches of float images, converted and traced. As in
+    # TracedModel the detection layer runs in float, it decodes boxes in image coordinates
+
+    def __init__(self, model=None, calibration=(), backend='fbgemm'):
+        super(QuantizedModel, self).__init__()
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        self.stride = model.stride
+        self.names = model.names
+        self.backend = backend
+        torch.backends.quantized.engine = backend
+
+        model = deepcopy(model).to('cpu').eval()
+        self.detect_layer = model.model[-1]
+        model.traced = True  # forward up to the detection layer
+        graph = torch.fx.symbolic_trace(model, concrete_args={'augment': False, 'profile': False})
+        calibration = iter(calibration)
+        x = next(calibration)
+        model = prepare_fx(graph, get_default_qconfig_mapping(backend), example_inputs=(x,))  # insert observers
+        n = 0
+        with torch.no_grad():
+            for x in itertools.chain([x], calibration):
+                model(x)
+                n += x.shape[0]
+        self.model = torch.jit.trace(convert_fx(model), x[:1])
+        print(f' model quantized to int8 ({backend}), calibrated on {n} images ')
+
+    def __getstate__(self):  # for torch.save(), the traced int8 model is saved as TorchScript
+        buffer = io.BytesIO()
+        torch.jit.save(self.model, buffer)
+        state = self.__dict__.copy()
+        state['_modules'] = {k: buffer.getvalue() if k == 'model' else m for k, m in self._modules.items()}
+        return state
+
+    def __setstate__(self, state):
+        state['_modules']['model'] = torch.jit.load(io.BytesIO(state['_modules']['model']), map_location='cpu')
+        super(QuantizedModel, self).__setstate__(state)
+
+    def fuse(self):  # already fused, for attempt_load()
+        return self
+
+    def forward(self, x, augment=False, profile=False):
+        torch.backends.quantized.engine = self.backend
+        out = self.model(x.float().contiguous())
+        out = self.detect_layer(out)
+        return out